@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""Offline benchmark of the report analytics on synthetic usage data
+
+Generates a data_cache.h5 compatible store (and a stand-in world layer) with
+the schema get_data writes, at a configurable number of usage rows, then
+times every cache load, aggregation, figure and map of plot_figures as a
+separate stage. No BigQuery credentials or real cache are needed.
+
+    python benchmark.py --rows 100000 --save-baseline
+    python benchmark.py --rows 100000 --compare
+    python benchmark.py --rows 100000 --cache-format parquet --streaming
+
+With --cache-format parquet the store is also copied to the Parquet cache
+files, and --streaming reads usage in chunks as plot_figures(streaming=True).
+
+The timings of a run can be saved as a baseline and later runs compared
+against it; stages slower than the baseline by more than --tolerance are
+reported as regressions and the exit status is 1.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+
+import geopandas
+import matplotlib
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+
+matplotlib.use('Agg')
+
+import report_analytics as ra  # noqa: E402
+
+BENCH_CACHE_DIR = 'bench_cache'
+BENCH_OUTPUT_DIR = 'bench_output'
+BASELINE_FILENAME = 'benchmark_baseline.json'
+GENERATE_CHUNKSIZE = 1_000_000
+
+DIGITAL_KENYA = '978-1-137-57878-5'
+
+# Stand-in countries for the world layer: (iso_a3, name, continent)
+COUNTRIES = [
+    ('KEN', 'Kenya', 'Africa'), ('NGA', 'Nigeria', 'Africa'), ('ZAF', 'South Africa', 'Africa'),
+    ('EGY', 'Egypt', 'Africa'), ('ETH', 'Ethiopia', 'Africa'), ('GHA', 'Ghana', 'Africa'),
+    ('TZA', 'Tanzania', 'Africa'), ('UGA', 'Uganda', 'Africa'), ('MAR', 'Morocco', 'Africa'),
+    ('BRA', 'Brazil', 'South America'), ('ARG', 'Argentina', 'South America'),
+    ('COL', 'Colombia', 'South America'), ('CHL', 'Chile', 'South America'),
+    ('PER', 'Peru', 'South America'), ('MEX', 'Mexico', 'North America'),
+    ('USA', 'United States of America', 'North America'), ('CAN', 'Canada', 'North America'),
+    ('GBR', 'United Kingdom', 'Europe'), ('DEU', 'Germany', 'Europe'), ('FRA', 'France', 'Europe'),
+    ('NOR', 'Norway', 'Europe'), ('ITA', 'Italy', 'Europe'), ('ESP', 'Spain', 'Europe'),
+    ('NLD', 'Netherlands', 'Europe'), ('SWE', 'Sweden', 'Europe'), ('POL', 'Poland', 'Europe'),
+    ('CHN', 'China', 'Asia'), ('IND', 'India', 'Asia'), ('JPN', 'Japan', 'Asia'),
+    ('IDN', 'Indonesia', 'Asia'), ('PAK', 'Pakistan', 'Asia'), ('KOR', 'South Korea', 'Asia'),
+    ('AUS', 'Australia', 'Oceania'), ('NZL', 'New Zealand', 'Oceania'),
+]
+CLUSTERS = ['Social Sciences', 'Humanities', 'Business & Economics',
+            'Medical, Biomedical and Life Sciences',
+            'Physical Sciences, Engineering, Math & Computer Science']
+CATEGORIES = ['Monograph', 'Contributed volume', 'Brief']
+FIRST_MONTH, LAST_MONTH = np.datetime64('2015-01', 'M'), np.datetime64('2020-06', 'M')
+
+
+class OfflineArtifacts:
+    """Stand-in for the precipy af outside of a precipy run
+
+    Cached files are read from cache_dir and the files a function registers
+    are moved to output_dir, where later lookups (e.g. by combine_panels)
+    find them."""
+
+    def __init__(self, cache_dir, output_dir):
+        self.cache_dir = cache_dir
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+
+    def path_to_cached_file(self, filename, fn_name=None):
+        output_filepath = os.path.join(self.output_dir, os.path.basename(filename))
+        if os.path.exists(output_filepath):
+            return output_filepath
+        return os.path.join(self.cache_dir, filename)
+
+    def add_existing_file(self, filename, remove=False):
+        target = os.path.join(self.output_dir, os.path.basename(filename))
+        if os.path.abspath(filename) != os.path.abspath(target):
+            (shutil.move if remove else shutil.copy2)(filename, target)
+
+    def generate_file(self, filename):
+        with open(filename, 'w') as f:
+            yield f
+        self.add_existing_file(filename, remove=True)
+
+
+##################
+# Synthetic Data #
+##################
+
+def synthetic_world(filepath):
+    """Write a shapefile with one rectangle per stand-in country"""
+    boxes = [box(-170 + 20 * (i % 17), -55 + 35 * (i // 17), -152 + 20 * (i % 17), -22 + 35 * (i // 17))
+             for i in range(len(COUNTRIES))]
+    world = geopandas.GeoDataFrame({'iso_a3': [c[0] for c in COUNTRIES],
+                                    'name': [c[1] for c in COUNTRIES],
+                                    'continent': [c[2] for c in COUNTRIES]},
+                                   geometry=boxes, crs='EPSG:4326')
+    world.to_file(filepath)
+
+
+def synthetic_books(rng, num_books):
+    """Per-book attributes, including the Digital Kenya case study title"""
+    isbns = [f'978-3-{i // 1000:03d}-{i % 1000:05d}-0' for i in range(num_books)]
+    isbns[0] = DIGITAL_KENYA
+    months = rng.integers(0, (LAST_MONTH - FIRST_MONTH).astype(int) - 6, num_books)
+    books = pd.DataFrame({
+        'isbn': isbns,
+        'is_oa': rng.random(num_books) < 0.2,
+        'pubdate': (FIRST_MONTH + months).astype('datetime64[ns]'),
+        'cluster': np.array(CLUSTERS)[rng.integers(0, len(CLUSTERS), num_books)],
+        'category': np.array(CATEGORIES)[rng.integers(0, len(CATEGORIES), num_books)],
+    })
+    books.loc[0, ['is_oa', 'cluster', 'category']] = [True, 'Business & Economics', 'Monograph']
+    books['year'] = books.pubdate.dt.year
+    return books
+
+
+def synthetic_usage(rng, books, rows):
+    """Usage rows, skewed towards popular books and countries"""
+    b = (rng.random(rows) ** 2 * len(books)).astype(int)
+    c = (rng.random(rows) ** 1.5 * len(COUNTRIES)).astype(int)
+    pub_month = books.pubdate.values.astype('datetime64[M]')[b]
+    month = np.minimum(pub_month + rng.integers(-2, 48, rows), LAST_MONTH)
+    return pd.DataFrame({
+        'isbn': books.isbn.values[b],
+        'iso_a3': np.array([c[0] for c in COUNTRIES])[c],
+        'country': np.array([c[1] for c in COUNTRIES])[c],
+        'is_oa': books.is_oa.values[b],
+        'logged': rng.random(rows) < 0.4,
+        'downloads': rng.geometric(0.3, rows),
+        'month': month.astype('datetime64[ns]'),
+        'pubdate': books.pubdate.values[b],
+        'year': books.year.values[b],
+        'cluster': books.cluster.values[b],
+        'category': books.category.values[b],
+    })
+
+
+def synthetic_tables(rng, books):
+    """The small tables of the cache: cites, webo, continents, normal, chapters, tld"""
+    num_books = len(books)
+    continents = pd.DataFrame({
+        'ISBN13': books.isbn,
+        'isOA': np.where(books.is_oa, 'yes', 'non'),
+        'title': [f'Title {i}' for i in range(num_books)],
+        'year': books.year,
+        'cluster': books.cluster,
+        'AFRICA': rng.random(num_books) < 0.05,
+        'LATIN_AMERICA': rng.random(num_books) < 0.03,
+    })
+    continents.loc[0, 'AFRICA'] = True
+
+    domains = [f'.{c[0][:2].lower()}' for c in COUNTRIES] + ['.com', '.org', '.edu', '.net']
+    tld = pd.DataFrame({
+        'Top_level_domains': domains,
+        'OATotal': rng.integers(10, 5000, len(domains)),
+        'nonOATotal': rng.integers(10, 5000, len(domains)),
+    })
+    tld['Total'] = tld.OATotal + tld.nonOATotal
+    for perc, total in [('TotalPerc', 'Total'), ('OAPerc', 'OATotal'), ('nonOAPerc', 'nonOATotal')]:
+        tld[perc] = (tld[total] / tld[total].sum() * 100).round(2)
+    tld['rankTotal'] = tld.Total.rank(ascending=False, method='first').astype(int)
+    tld['rankOA'] = tld.OATotal.rank(ascending=False, method='first').astype(int)
+
+    return {
+        'cites': pd.DataFrame({'isbn': books.isbn, 'Citations': rng.poisson(3, num_books)}),
+        'webo': pd.DataFrame({'isbn': books.isbn, 'Domains': rng.poisson(5, num_books)}),
+        'continents': continents,
+        'normal': pd.DataFrame({'iso_a3': [c[0] for c in COUNTRIES],
+                                'Publications': rng.integers(100, 100000, len(COUNTRIES))}),
+        'chapters': pd.DataFrame({'isbn': books.isbn,
+                                  'nr_of_chapters': rng.integers(3, 30, num_books),
+                                  'nr_of_arabic_pages': rng.integers(80, 600, num_books)}),
+        'tld': tld,
+    }
+
+
+def generate_cache(cache_dir, rows, seed=0, chunksize=GENERATE_CHUNKSIZE):
+    """Write a synthetic data_cache.h5 and world layer to cache_dir
+
+    Usage is generated and appended in chunks, so the store can be larger
+    than memory, and the usage cube is built from the same chunks."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(cache_dir, exist_ok=True)
+    books = synthetic_books(rng, int(np.clip(rows // 500, 100, 50_000)))
+    store_filepath = os.path.join(cache_dir, ra.HDF5_CANONICAL_FILENAME)
+
+    def chunks():
+        for start in range(0, rows, chunksize):
+            chunk = synthetic_usage(rng, books, min(chunksize, rows - start))
+            store.append('usage', chunk, format='table', index=False,
+                         min_itemsize={'isbn': 20, 'iso_a3': 3, 'country': 32,
+                                       'cluster': 64, 'category': 24})
+            yield chunk
+
+    with pd.HDFStore(store_filepath, mode='w') as store:
+        cube, _, _ = ra.stream_usage_aggregates(chunks())
+        store.put('usage_cube', cube)
+        for name, df in synthetic_tables(rng, books).items():
+            store.put(name, df)
+
+    synthetic_world(os.path.join(cache_dir, 'world.shp'))
+    print(f'Generated {rows:,} usage rows for {len(books):,} books in {cache_dir}')
+
+
+def write_parquet_cache(cache_dir, chunksize=GENERATE_CHUNKSIZE):
+    """Copy the synthetic data_cache.h5 in cache_dir to the Parquet cache files
+
+    Usage is copied in chunks, each written as one row group per partition
+    like ra.write_partitioned_parquet, so the store is never loaded in full."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    def parquet_filepath(name):
+        return os.path.join(cache_dir, ra.PARQUET_CACHE_TEMPLATE.format(name))
+
+    with pd.HDFStore(os.path.join(cache_dir, ra.HDF5_CANONICAL_FILENAME), mode='r') as store:
+        writer = None
+        try:
+            for chunk in store.select('usage', chunksize=chunksize):
+                chunk = chunk.sort_values(ra.USAGE_PARTITION_COLS, kind='mergesort')
+                if writer is None:
+                    schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                    writer = pq.ParquetWriter(parquet_filepath('usage'), schema)
+                for _, partition in chunk.groupby(ra.USAGE_PARTITION_COLS, sort=False, dropna=False):
+                    writer.write_table(pa.Table.from_pandas(partition, schema=schema,
+                                                            preserve_index=False))
+        finally:
+            if writer is not None:
+                writer.close()
+        for key in store.keys():
+            if key != '/usage':
+                store[key].to_parquet(parquet_filepath(key.lstrip('/')), index=False)
+    print(f'Copied the cache to Parquet in {cache_dir}')
+
+
+#############
+# Benchmark #
+#############
+
+def run_benchmark(cache_dir, output_dir, cache_format='hdf5', streaming=False,
+                  chunksize=ra.STREAM_CHUNKSIZE):
+    """Time every stage of the report on the cache in cache_dir
+
+    Each figure job is rendered on its own so that one failing figure does
+    not hide the timings of the others. Returns the recorded stages and the
+    jobs that failed."""
+    ra.WORLD_SOURCE = os.path.join(cache_dir, 'world.shp')
+    af = OfflineArtifacts(cache_dir, output_dir)
+    failures = {}
+    with ra.RunProfile() as profile:
+        data = ra.load_figure_data(af, cache_format, streaming=streaming, chunksize=chunksize)
+        for i, job in enumerate(ra.FIGURE_JOBS):
+            try:
+                ra.render_figures(af, data, jobs=[job], workers=1, cache_dir=None, release=False)
+            except Exception as e:
+                failures[job[0].__name__] = repr(e)
+                print(f'{job[0].__name__} failed: {e!r}')
+            # Release across the whole run, as render_figures does for its jobs
+            data.release_unneeded(ra.FIGURE_JOBS[i + 1:])
+        data.report_loads()
+        profile.write(af)
+    return profile.stages, failures
+
+
+def stage_totals(stages):
+    """Wall time per stage name, summed over repeated stages (e.g. map_compare)"""
+    totals = {}
+    for stage in stages:
+        totals[stage['stage']] = totals.get(stage['stage'], 0) + stage['wall_s']
+    return totals
+
+
+def compare(totals, baseline, tolerance):
+    """Stages slower than the baseline by more than tolerance (a fraction)"""
+    regressions = {}
+    print(f'{"stage":<48} {"baseline":>9} {"now":>9} {"ratio":>7}')
+    for name, seconds in totals.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f'{name:<48} {"":>9} {seconds:9.3f} {"new":>7}')
+            continue
+        ratio = seconds / before if before else np.inf
+        flag = ' <-' if ratio > 1 + tolerance and seconds - before > 0.01 else ''
+        print(f'{name:<48} {before:9.3f} {seconds:9.3f} {ratio:7.2f}{flag}')
+        if flag:
+            regressions[name] = ratio
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=100_000,
+                        help='usage rows to generate (10k to 100M)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache-dir', default=BENCH_CACHE_DIR)
+    parser.add_argument('--output-dir', default=BENCH_OUTPUT_DIR)
+    parser.add_argument('--regenerate', action='store_true',
+                        help='regenerate the synthetic cache even if it exists')
+    parser.add_argument('--cache-format', choices=['hdf5', 'parquet'], default='hdf5',
+                        help='cache the report reads, parquet is copied from the HDF5 store')
+    parser.add_argument('--streaming', action='store_true',
+                        help='read usage in chunks and reduce it to the cube while reading')
+    parser.add_argument('--chunksize', type=int, default=ra.STREAM_CHUNKSIZE,
+                        help='usage rows per chunk with --streaming')
+    parser.add_argument('--baseline', default=BASELINE_FILENAME)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline, as a fraction')
+    args = parser.parse_args(argv)
+
+    cache_dir = os.path.join(args.cache_dir, f'{args.rows}_{args.seed}')
+    regenerate = args.regenerate or not os.path.exists(os.path.join(cache_dir, ra.HDF5_CANONICAL_FILENAME))
+    if regenerate:
+        generate_cache(cache_dir, args.rows, args.seed)
+    parquet_usage = os.path.join(cache_dir, ra.PARQUET_CACHE_TEMPLATE.format('usage'))
+    if args.cache_format == 'parquet' and (regenerate or not os.path.exists(parquet_usage)):
+        write_parquet_cache(cache_dir)
+
+    stages, failures = run_benchmark(cache_dir, args.output_dir, args.cache_format,
+                                     args.streaming, args.chunksize)
+    totals = stage_totals(stages)
+
+    status = 1 if failures else 0
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['rows'] != args.rows:
+            print(f'Baseline was recorded for {baseline["rows"]:,} rows, not {args.rows:,}')
+        recorded = (baseline.get('cache_format', 'hdf5'), baseline.get('streaming', False))
+        if recorded != (args.cache_format, args.streaming):
+            print(f'Baseline was recorded for cache format {recorded[0]}, streaming {recorded[1]}')
+        if compare(totals, baseline['stages'], args.tolerance):
+            status = 1
+    else:
+        for name, seconds in totals.items():
+            print(f'{name:<48} {seconds:9.3f}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'rows': args.rows, 'seed': args.seed, 'cache_format': args.cache_format,
+                       'streaming': args.streaming, 'stages': totals}, f, indent=1)
+        print(f'Saved baseline to {args.baseline}')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,12 +10,63 @@ import seaborn as sns
 import matplotlib.gridspec as gs
 import matplotlib.colors as colors
 from matplotlib.lines import Line2D
+from matplotlib.path import Path
+from matplotlib.patches import PathPatch
+from matplotlib.collections import PatchCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import matplotlib.cm as cm
+import cProfile
+import hashlib
+import inspect
+import itertools
 import json
+import multiprocessing as mp
+import os
+import shutil
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial
 from num2words import num2words
 from PIL import Image
+from scipy import sparse
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS is then not recorded
+    resource = None
 
 project_id = 'coki-scratch-space'
+BQ_DATASET = 'coki-scratch-space.SpringerNature'
 HDF5_CANONICAL_FILENAME = 'data_cache.h5'
+PARQUET_CACHE_TEMPLATE = 'data_cache_{}.parquet'
+FIGURE_CACHE_DIR = '.figure_cache'
+CACHE_FORMAT = 'hdf5'  # or 'parquet' for the columnar cache
+USAGE_PARTITION_COLS = ['year', 'cluster']
+STREAM_CHUNKSIZE = 1_000_000  # usage rows per chunk in streaming mode
+STREAM_MERGE_FANIN = 8  # partial cubes merged at once in streaming mode
+PROFILE_FILENAME = 'run_profile'  # written as .json and .csv with profile=True
+PNG_COMPRESS_LEVEL = 6  # zlib level of the composed figure PNGs, 1 is fastest
+PNG_ENCODE_WORKERS = 1  # threads encoding the PNGs of a composed figure
+BOOTSTRAP_CACHE_DIR = '.bootstrap_cache'
+BOOTSTRAP_RESAMPLES = 1000  # as seaborn's n_boot
+BOOTSTRAP_LEVEL = 95  # width of the confidence intervals in percent
+BOOTSTRAP_SEED = 2021
+BOOTSTRAP_CHUNKSIZE = 20_000_000  # resampled values per index matrix
+BOOTSTRAP_WORKERS = 1  # threads resampling chunks, numpy releases the GIL
+
+# Columns read back from the cache for each table, None loads every column
+CACHE_COLUMNS = {
+    'usage': ['isbn', 'iso_a3', 'country', 'is_oa', 'logged', 'downloads',
+              'month', 'pubdate', 'year', 'cluster', 'category'],
+    'cites': ['isbn', 'Citations'],
+    'webo': ['isbn', 'Domains'],
+    'continents': None,
+    'normal': ['iso_a3', 'Publications'],
+    'chapters': ['isbn', 'nr_of_chapters', 'nr_of_arabic_pages'],
+    'tld': None,
+}
 sns.set_context('paper', font_scale=1.4)
 coard = sns.color_palette([
     '#00DDA8',
@@ -63,127 +114,678 @@ def rgb_to_dec(value):
 lilacs = get_continuous_cmap(['#ffffff', '#937cb9'])
 coardmap = get_continuous_cmap(['#ffffff', '#000033'])
 
+# Filename template and colormap of each saved variant of a map
+MAP_VARIANTS = [('{}.png', coardmap), ('{}_lilac.png', lilacs)]
+
 
 ################
 # Collect Data #
 ################
 
 def get_data(af,
-             project_id=project_id):
-    scopes = [
-        'https://www.googleapis.com/auth/cloud-platform',
-        'https://www.googleapis.com/auth/drive',
-    ]
-
-    credentials = pydata_google_auth.get_user_credentials(
-        scopes,
+             project_id=project_id,
+             cache_format=CACHE_FORMAT,
+             backend=None,
+             max_workers=None,
+             incremental=False,
+             fetch_mode='raw'):
+    if backend is None:
+        scopes = [
+            'https://www.googleapis.com/auth/cloud-platform',
+            'https://www.googleapis.com/auth/drive',
+        ]
+
+        credentials = pydata_google_auth.get_user_credentials(
+            scopes,
+        )
+        backend = bigquery_backend(project_id, credentials=credentials)
+
+    # Pre-aggregated mode fetches the usage cube and book/country attributes
+    # instead of the row-level usage table
+    aggregated = fetch_mode == 'aggregated'
+    fetchers = AGGREGATE_FETCHERS if aggregated else FETCHERS
+    usage_table = 'usage_cube' if aggregated else 'usage'
+
+    # An incremental refresh only fetches the months after the cached ones. A
+    # usage table cached in HDF5 table format is appended to, so it is not loaded
+    appendable = incremental and not aggregated and cached_table_appendable(af, 'usage', cache_format)
+    previous = None
+    if incremental:
+        previous = load_previous_usage(af, cache_format, with_usage=not (aggregated or appendable))
+    if previous is not None:
+        latest_month, cached_usage, cached_cube = previous
+        print('Refreshing usage after', latest_month)
+        fetchers = dict(fetchers, **{usage_table: partial(fetchers[usage_table], since=latest_month)})
+
+    # Collect the data from the various tables concurrently
+    tables = fetch_tables(backend, max_workers=max_workers, fetchers=fetchers)
+
+    # Keep the usage cube with the cache so a refresh only aggregates new rows
+    if aggregated:
+        cube = tables['usage_cube']
+    else:
+        cube = build_usage_cube(tables['usage'])
+    append = []
+    if previous is not None:
+        new_rows = len(tables[usage_table])
+        print(f'Fetched {new_rows:,} new {usage_table} rows')
+        cube = merge_usage_cubes(cached_cube, cast_like(cube, cached_cube.dtypes)) if new_rows else cached_cube
+        if appendable:
+            append = ['usage']
+        elif not aggregated and new_rows:
+            tables['usage'] = pd.concat([cached_usage, cast_like(tables['usage'], cached_usage.dtypes)],
+                                        ignore_index=True)
+        elif not aggregated:
+            tables['usage'] = cached_usage
+    tables['usage_cube'] = cube
+    tables['cache_meta'] = pd.DataFrame({'latest_month': [cube.month.max()]})
+
+    write_cache(af, tables, cache_format, append=append)
+
+
+QueryBackend = namedtuple('QueryBackend', ['read', 'table'])
+
+
+def bigquery_backend(project_id=project_id, dataset=BQ_DATASET, credentials=None):
+    """Query layer reading from the BigQuery dataset"""
+    return QueryBackend(
+        read=lambda sql: pd.read_gbq(sql, project_id=project_id, credentials=credentials),
+        table=lambda name: f'`{dataset}.{name}`'
     )
 
-    # Collect the data from various tables
-    cites = get_citation_data()
-    webo = get_webometrics_data()
-    continents = get_continents_data()
-    normal = get_normalisation_data()
-    chapters = get_chapterspages()
-    tld = get_tld_data()
-    usage = get_usage_data()
-
-    with pd.HDFStore(HDF5_CANONICAL_FILENAME) as store:
-        store['usage'] = usage
-        store['cites'] = cites
-        store['webo'] = webo
-        store['continents'] = continents
-        store['normal'] = normal
-        store['chapters'] = chapters
-        store['tld'] = tld
-    af.add_existing_file(HDF5_CANONICAL_FILENAME, remove=True)
-
-
-def get_usage_data():
-    sql = '''
+
+def sql_backend(connect):
+    """Query layer for a local stand-in database (e.g. SQLite or DuckDB)
+
+    `connect` returns a new connection to a database holding the fixture tables
+    under their BigQuery table names (rawv4, citations, ...). A connection is
+    opened per query so that the concurrent fetches never share one."""
+
+    def read(sql):
+        connection = connect()
+        try:
+            if hasattr(connection, 'df'):  # DuckDB
+                return connection.execute(sql).df()
+            return pd.read_sql_query(sql, connection)
+        finally:
+            connection.close()
+
+    return QueryBackend(read=read, table=lambda name: name)
+
+
+def fetch_tables(backend, max_workers=None, retries=3, retry_wait=5, fetchers=None):
+    """Run every table fetch in `fetchers` (FETCHERS by default) concurrently
+
+    The queries are I/O bound so a thread pool brings the wall time down to the
+    slowest table. Each fetch is timed and retried with a linear backoff.
+    Returns {name: df}."""
+    fetchers = fetchers or FETCHERS
+    max_workers = max_workers or len(fetchers)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {name: pool.submit(fetch_with_retry, name, fetcher, backend, retries, retry_wait)
+                   for name, fetcher in fetchers.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def fetch_with_retry(name, fetcher, backend, retries=3, retry_wait=5):
+    for attempt in range(1, retries + 1):
+        start = time.perf_counter()
+        try:
+            df = fetcher(backend)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print(f'Fetching {name} failed (attempt {attempt} of {retries}): {e}')
+            time.sleep(retry_wait * attempt)
+        else:
+            print(f'Fetched {name}: {len(df):,} rows in {time.perf_counter() - start:.1f}s')
+            return df
+
+
+def get_usage_data(backend=None, since=None):
+    backend = backend or bigquery_backend()
+    where = f'WHERE month > {sql_literal(since)}' if since is not None else ''
+    sql = f'''
     SELECT *
-    FROM `coki-scratch-space.SpringerNature.rawv4`
+    FROM {backend.table('rawv4')}
+    {where}
     ORDER BY year, cluster, title 
     '''
 
-    df = pd.read_gbq(sql, project_id=project_id)
+    df = backend.read(sql)
     return df
 
 
-def get_chapterspages():
-    sql = '''
+def get_chapterspages(backend=None):
+    backend = backend or bigquery_backend()
+    sql = f'''
     SELECT *
-    FROM `coki-scratch-space.SpringerNature.chapter_pagenumbers`
+    FROM {backend.table('chapter_pagenumbers')}
     '''
 
-    df = pd.read_gbq(sql, project_id=project_id)
+    df = backend.read(sql)
     return df
 
 
-def get_citation_data():
-    sql = '''
+def get_citation_data(backend=None):
+    backend = backend or bigquery_backend()
+    sql = f'''
     SELECT 
         isbn, 
         citations as Citations
-    FROM `coki-scratch-space.SpringerNature.citations`
+    FROM {backend.table('citations')}
     '''
 
-    df = pd.read_gbq(sql, project_id=project_id)
+    df = backend.read(sql)
     return df
 
 
-def get_webometrics_data():
-    sql = '''
+def get_webometrics_data(backend=None):
+    backend = backend or bigquery_backend()
+    sql = f'''
     SELECT 
         isbn, 
         tld as TLD, 
         domain as Domains, 
         url
-    FROM `coki-scratch-space.SpringerNature.webometrics`
+    FROM {backend.table('webometrics')}
     '''
 
-    df = pd.read_gbq(sql, project_id=project_id)
+    df = backend.read(sql)
     return df
 
 
-def get_continents_data():
-    sql = '''
+def get_continents_data(backend=None):
+    backend = backend or bigquery_backend()
+    sql = f'''
 SELECT *
-FROM `coki-scratch-space.SpringerNature.springerTitleNames_Continents`
+FROM {backend.table('springerTitleNames_Continents')}
 ORDER BY year, cluster, title
     '''
-    df = pd.read_gbq(sql, project_id=project_id)
+    df = backend.read(sql)
     return df
 
 
-def get_normalisation_data():
-    sql = '''
+def get_normalisation_data(backend=None):
+    backend = backend or bigquery_backend()
+    sql = f'''
 SELECT *
-FROM `coki-scratch-space.SpringerNature.publications`
+FROM {backend.table('publications')}
 '''
-    df = pd.read_gbq(sql, project_id=project_id)
+    df = backend.read(sql)
     return df
 
 
-def get_tld_data():
-    sql = '''
+def get_tld_data(backend=None):
+    backend = backend or bigquery_backend()
+    sql = f'''
 SELECT *
-FROM `coki-scratch-space.SpringerNature.tld`
+FROM {backend.table('tld')}
 '''
-    df = pd.read_gbq(sql, project_id=project_id)
+    df = backend.read(sql)
+    return df
+
+
+def sql_literal(value):
+    """Quote a month value for a WHERE clause in the form it is stored"""
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return "'" + pd.Timestamp(value).strftime('%Y-%m-%d') + "'"
+
+
+def get_usage_cube_data(backend=None, since=None):
+    # Downloads summed at the usage cube grain, see build_usage_cube
+    backend = backend or bigquery_backend()
+    where = f'WHERE month > {sql_literal(since)}' if since is not None else ''
+    sql = f'''
+    SELECT 
+        isbn, 
+        iso_a3, 
+        is_oa, 
+        logged, 
+        month, 
+        SUM(downloads) as downloads
+    FROM {backend.table('rawv4')}
+    {where}
+    GROUP BY isbn, iso_a3, is_oa, logged, month
+    '''
+
+    df = backend.read(sql)
+    return df
+
+
+def get_book_data(backend=None):
+    # Per-book attributes of the usage table
+    backend = backend or bigquery_backend()
+    sql = f'''
+    SELECT 
+        isbn, 
+        MAX(pubdate) as pubdate, 
+        MAX(year) as year, 
+        MAX(cluster) as cluster, 
+        MAX(category) as category
+    FROM {backend.table('rawv4')}
+    GROUP BY isbn
+    '''
+
+    df = backend.read(sql)
+    return df
+
+
+def get_country_data(backend=None):
+    # Country names of the usage table
+    backend = backend or bigquery_backend()
+    sql = f'''
+    SELECT 
+        iso_a3, 
+        MAX(country) as country
+    FROM {backend.table('rawv4')}
+    GROUP BY iso_a3
+    '''
+
+    df = backend.read(sql)
+    return df
+
+
+FETCHERS = {
+    'cites': get_citation_data,
+    'webo': get_webometrics_data,
+    'continents': get_continents_data,
+    'normal': get_normalisation_data,
+    'chapters': get_chapterspages,
+    'tld': get_tld_data,
+    'usage': get_usage_data,
+}
+
+# Pre-aggregated mode: the row-level usage table is replaced by the usage cube
+# plus the book and country attributes needed to rebuild it at the cube grain
+AGGREGATE_FETCHERS = {name: fetcher for name, fetcher in FETCHERS.items() if name != 'usage'}
+AGGREGATE_FETCHERS.update({
+    'usage_cube': get_usage_cube_data,
+    'books': get_book_data,
+    'countries': get_country_data,
+})
+
+
+###############
+# Run Profile #
+###############
+
+# Profile of the current run, the RunProfile whose with block is running
+_PROFILE = None
+
+PROFILE_COLUMNS = ['stage', 'depth', 'rows', 'wall_s', 'cpu_s', 'peak_rss_delta_mb', 'pid']
+
+
+class RunProfile:
+    """Wall time, CPU time, peak RSS growth and row counts per pipeline stage
+
+    Stages are recorded by profile_stage while this is the active profile.
+    Nested stages (e.g. the savefig calls of a figure) have a higher depth,
+    so totals should be taken over depth 0. With cprofile_dir set, every
+    outermost stage also runs under cProfile and is dumped to
+    <cprofile_dir>/<stage>.prof.
+
+    Used as a context manager it is the active profile inside the with
+    block, and the previously active one (if any) is restored after it."""
+
+    def __init__(self, cprofile_dir=None):
+        self.stages = []
+        self.cprofile_dir = cprofile_dir
+        self.depth = 0
+        self.parent = None
+
+    def __enter__(self):
+        global _PROFILE
+        self.parent, _PROFILE = _PROFILE, self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _PROFILE
+        _PROFILE, self.parent = self.parent, None
+
+    def write(self, af, filename=PROFILE_FILENAME):
+        stages = pd.DataFrame(self.stages, columns=PROFILE_COLUMNS).astype({'rows': 'Int64'})
+        for f in af.generate_file(f'{filename}.json'):
+            json.dump({'stages': self.stages,
+                       'wall_s': stages.loc[stages.depth == 0, 'wall_s'].sum(),
+                       'cpu_s': stages.loc[stages.depth == 0, 'cpu_s'].sum()}, f, indent=1)
+        for f in af.generate_file(f'{filename}.csv'):
+            stages.to_csv(f, index=False)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, None where unsupported"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+@contextmanager
+def profile_stage(name, rows=None):
+    """Record a pipeline stage in the active run profile, if there is one
+
+    Yields the stage record so that a row count can be set once it is known."""
+    profile = _PROFILE
+    stage = {'stage': name, 'rows': rows}
+    if profile is None:
+        yield stage
+        return
+
+    profiler = cProfile.Profile() if profile.cprofile_dir and profile.depth == 0 else None
+    stage['depth'] = profile.depth
+    profile.depth += 1
+    rss = peak_rss_mb()
+    wall, cpu = time.perf_counter(), time.process_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield stage
+    finally:
+        if profiler:
+            profiler.disable()
+        stage['wall_s'] = time.perf_counter() - wall
+        stage['cpu_s'] = time.process_time() - cpu
+        stage['peak_rss_delta_mb'] = rss and peak_rss_mb() - rss
+        stage['pid'] = os.getpid()
+        profile.depth -= 1
+        profile.stages.append(stage)
+        if profiler:
+            os.makedirs(profile.cprofile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile.cprofile_dir,
+                                             name.replace(' ', '_').replace('/', '_') + '.prof'))
+
+
+##############
+# Data Cache #
+##############
+
+def write_cache(af, tables, cache_format=CACHE_FORMAT, append=()):
+    """Write the collected tables to the HDF5 store or to one Parquet file each
+
+    The tables named in `append` only hold new rows, which are appended to
+    those of the previous HDF5 store (see cached_table_appendable)."""
+    if cache_format == 'hdf5':
+        if append:
+            previous = af.path_to_cached_file(HDF5_CANONICAL_FILENAME, "get_data")
+            if not (os.path.exists(HDF5_CANONICAL_FILENAME)
+                    and os.path.samefile(previous, HDF5_CANONICAL_FILENAME)):
+                shutil.copyfile(previous, HDF5_CANONICAL_FILENAME)
+        with pd.HDFStore(HDF5_CANONICAL_FILENAME, mode='a' if append else 'w') as store:
+            for name, df in tables.items():
+                # Table format so that streaming mode can read usage in chunks
+                if name in append:
+                    append_to_table(store, name, df)
+                elif name == 'usage':
+                    store.put(name, table_format_flags(df), format='table')
+                else:
+                    store.put(name, df, format='fixed')
+        af.add_existing_file(HDF5_CANONICAL_FILENAME, remove=True)
+
+    elif cache_format == 'parquet':
+        for name, df in tables.items():
+            filename = PARQUET_CACHE_TEMPLATE.format(name)
+            if name == 'usage':
+                write_partitioned_parquet(df, filename, USAGE_PARTITION_COLS)
+            else:
+                df.to_parquet(filename, index=False)
+            af.add_existing_file(filename, remove=True)
+
+    else:
+        raise ValueError(f'Unknown cache format: {cache_format}')
+
+
+def cached_table_appendable(af, name, cache_format=CACHE_FORMAT):
+    """Whether the previous cache holds `name` as an HDF5 table that new rows
+    can be appended to"""
+    if cache_format != 'hdf5':
+        return False
+    store_filepath = af.path_to_cached_file(HDF5_CANONICAL_FILENAME, "get_data")
+    if not os.path.exists(store_filepath):
+        return False
+    with pd.HDFStore(store_filepath, mode='r') as store:
+        return name in store and store.get_storer(name).is_table
+
+
+def append_to_table(store, name, df):
+    """Append rows to a table format node, cast to the dtypes it holds
+
+    Rows that do not fit the table (e.g. strings longer than it was sized
+    for, or missing flags in a boolean column) make it be rewritten whole."""
+    if not len(df):
+        return
+    storer = store.get_storer(name)
+    stored = store.select(name, stop=0)
+    df = cast_like(table_format_flags(df), stored.dtypes)
+    df.index = pd.RangeIndex(storer.nrows, storer.nrows + len(df))
+    try:
+        store.append(name, df[stored.columns], index=False)
+    except (KeyError, TypeError, ValueError) as e:
+        print(f'Rewriting {name}, the new rows do not fit the cached table: {e}')
+        df = pd.concat([store[name], df], ignore_index=True)
+        store.put(name, table_format_flags(df), format='table')
+
+
+def cast_like(df, dtypes):
+    """Newly fetched rows with the dtypes of the cached table they are added
+    to, where that keeps their missing values (None flags stay as they are)"""
+    casts = {}
+    for column, dtype in dtypes.items():
+        if column not in df or df[column].dtype == dtype:
+            continue
+        if df[column].isna().any() and (dtype == bool or dtype.kind in 'iu'):
+            continue
+        try:
+            casts[column] = df[column].astype(dtype)
+        except (TypeError, ValueError):
+            pass
+    return df.assign(**casts) if casts else df
+
+
+def table_format_flags(df):
+    """The usage flags as booleans, or as floats (NaN where missing) if some
+    are missing, since the HDF5 table format cannot store object columns of
+    bools and None. apply_usage_schema keeps flags with missing values as they
+    are, so the float flags compare equal to True/False and drop as NaN"""
+    flags = {}
+    for column in USAGE_FLAGS:
+        if column in df and df[column].dtype != bool:
+            flags[column] = df[column].astype(float if df[column].isna().any() else bool)
+    return df.assign(**flags) if flags else df
+
+
+def write_partitioned_parquet(df, filename, partition_cols):
+    """Write a Parquet file with one row group per partition
+
+    Each row group carries min/max statistics for the partition columns, so a
+    filtered read (e.g. on year or cluster) skips the other partitions without
+    decoding them while the cache stays a single file."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df = df.sort_values(partition_cols, kind='mergesort')
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(filename, schema) as writer:
+        for _, partition in df.groupby(partition_cols, sort=False, dropna=False):
+            writer.write_table(pa.Table.from_pandas(partition, schema=schema, preserve_index=False))
+
+
+def load_cached_table(af, name, cache_format=CACHE_FORMAT, columns=None, filters=None,
+                      missing_ok=False, categories=None):
+    """Load one table written by get_data
+
+    The Parquet cache only decodes `columns` and the row groups matching
+    `filters` (pyarrow DNF, e.g. [('year', '>=', 2016)]), and decodes the
+    string columns in `categories` straight to categoricals. The HDF5 store is
+    read in full and pruned afterwards, which is the baseline to compare with.
+    With missing_ok a table the cache does not hold is returned as None."""
+    start = time.perf_counter()
+    with profile_stage(f'load {name}') as stage:
+        if cache_format == 'hdf5':
+            store_filepath = af.path_to_cached_file(HDF5_CANONICAL_FILENAME, "get_data")
+            if missing_ok and not os.path.exists(store_filepath):
+                return None
+            # Read only, opening in append mode would touch the file's mtime
+            # that the figure cache is keyed on (see cache_file_digest)
+            with pd.HDFStore(store_filepath, mode='r') as store:
+                if missing_ok and name not in store:
+                    return None
+                df = store[name]
+            if filters:
+                df = df[_filters_mask(df, filters)]
+            if columns:
+                df = df[columns]
+
+        elif cache_format == 'parquet':
+            filepath = af.path_to_cached_file(PARQUET_CACHE_TEMPLATE.format(name), "get_data")
+            if missing_ok and not os.path.exists(filepath):
+                return None
+            df = pd.read_parquet(filepath, columns=columns, filters=filters,
+                                 read_dictionary=categories)
+
+        else:
+            raise ValueError(f'Unknown cache format: {cache_format}')
+
+        stage['rows'] = len(df)
+
+    print(f'Loaded {name} ({cache_format}): {len(df):,} rows in {time.perf_counter() - start:.2f}s')
     return df
 
 
+def iter_cached_table(af, name, cache_format=CACHE_FORMAT, columns=None, filters=None,
+                      chunksize=STREAM_CHUNKSIZE):
+    """Read one table written by get_data as chunks of about `chunksize` rows
+
+    Only one chunk is held in memory at a time: the Parquet cache is scanned
+    batch by batch (skipping row groups excluded by `filters`) and the HDF5
+    store must hold the table in table format. Yields nothing if the cache
+    does not hold the table."""
+    start = time.perf_counter()
+    rows = 0
+    if cache_format == 'hdf5':
+        store_filepath = af.path_to_cached_file(HDF5_CANONICAL_FILENAME, "get_data")
+        if not os.path.exists(store_filepath):
+            return
+        with pd.HDFStore(store_filepath, mode='r') as store:
+            if name not in store:
+                return
+            if not store.get_storer(name).is_table:
+                raise ValueError(f'{name} was cached in fixed format, re-run get_data to stream it')
+            read_columns = columns and list(dict.fromkeys(columns + [c for c, _, _ in filters or []]))
+            for chunk in store.select(name, columns=read_columns, chunksize=chunksize):
+                if filters:
+                    chunk = chunk[_filters_mask(chunk, filters)]
+                rows += len(chunk)
+                yield chunk[columns] if columns else chunk
+
+    elif cache_format == 'parquet':
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        filepath = af.path_to_cached_file(PARQUET_CACHE_TEMPLATE.format(name), "get_data")
+        if not os.path.exists(filepath):
+            return
+        expression = pq.filters_to_expression(filters) if filters else None
+        batches = ds.dataset(filepath, format='parquet').to_batches(
+            columns=columns, filter=expression, batch_size=chunksize)
+        for batch in batches:
+            rows += batch.num_rows
+            yield batch.to_pandas()
+
+    else:
+        raise ValueError(f'Unknown cache format: {cache_format}')
+
+    print(f'Streamed {name} ({cache_format}): {rows:,} rows in {time.perf_counter() - start:.2f}s')
+
+
+def load_previous_usage(af, cache_format=CACHE_FORMAT, with_usage=True):
+    """Latest month, usage table and usage cube from the previous get_data run
+
+    The usage table is None for a pre-aggregated cache (or with_usage=False).
+    Returns None when there is no earlier cache to refresh, in which case the
+    full usage table is fetched."""
+    try:
+        meta = load_cached_table(af, 'cache_meta', cache_format)
+        usage = load_cached_table(af, 'usage', cache_format) if with_usage else None
+        cube = load_cached_table(af, 'usage_cube', cache_format)
+    except Exception as e:
+        print('No usage cache to refresh, fetching all months:', e)
+        return None
+    return meta.latest_month.iloc[0], usage, cube
+
+
+def _filters_mask(df, filters):
+    # Conjunction of (column, op, value) filters, for stores without pushdown
+    ops = {'==': pd.Series.eq, '=': pd.Series.eq, '!=': pd.Series.ne,
+           '<': pd.Series.lt, '<=': pd.Series.le, '>': pd.Series.gt, '>=': pd.Series.ge,
+           'in': pd.Series.isin}
+    mask = np.ones(len(df), dtype=bool)
+    for column, op, value in filters:
+        mask &= ops[op](df[column], value).values
+    return mask
+
+
 ###################
 # Data Processing #
 ###################
 
+# Compact dtypes for the usage table, applied when it is loaded
+USAGE_CATEGORIES = ['isbn', 'iso_a3', 'country', 'cluster', 'category', 'title']
+USAGE_INTEGERS = {'downloads': 'int32', 'year': 'int16'}
+USAGE_FLAGS = ['is_oa', 'logged']
+
+
+def apply_usage_schema(usage):
+    """Convert a usage table (or cube) to compact dtypes
+
+    Low-cardinality keys become categoricals, counts small integers, the
+    flags booleans and month an integer month number, so the groupbys run on
+    compact codes. Columns with missing values keep a dtype that holds them."""
+    for column in USAGE_CATEGORIES:
+        if column in usage:
+            usage[column] = usage[column].astype('category')
+    for column, dtype in USAGE_INTEGERS.items():
+        if column in usage and not usage[column].isna().any():
+            usage[column] = usage[column].astype(dtype)
+    for column in USAGE_FLAGS:
+        if column in usage and not usage[column].isna().any():
+            usage[column] = usage[column].astype(bool)
+    if 'month' in usage:
+        usage['month'] = month_number(usage['month'])
+    return usage
+
+
+def month_number(dates):
+    """Months since January 1970 (the Period('M') ordinal) as int32
+
+    Dates are parsed once per distinct value. Integer input is taken to be
+    month numbers already; missing dates give <NA> in a nullable Int32."""
+    dates = pd.Series(dates)
+    if pd.api.types.is_integer_dtype(dates):
+        return dates
+    if pd.api.types.is_datetime64_any_dtype(dates) and not dates.isna().any():
+        numbers = (dates.dt.year.values - 1970) * 12 + dates.dt.month.values - 1
+        return pd.Series(numbers.astype('int32'), index=dates.index, name=dates.name)
+    codes, uniques = pd.factorize(dates)
+    uniques = pd.Series(pd.to_datetime(uniques))
+    numbers = (uniques.dt.year - 1970) * 12 + uniques.dt.month - 1
+    numbers = pd.array(numbers.values, dtype='Int32').take(codes, allow_fill=True)
+    if numbers.isna().any():
+        return pd.Series(numbers, index=dates.index, name=dates.name)
+    return pd.Series(numbers.to_numpy('int32'), index=dates.index, name=dates.name)
+
+
+def months_after_publication(month, pubdate):
+    """Whole calendar months from the publication month to the usage month
+
+    Matches the Period('M') difference used previously, but as integer
+    arithmetic on month numbers over the whole column."""
+    return month_number(month) - month_number(pubdate)
+
+
 def process_usage_data(usage):
-    # Minor data manipulations for date-time and number of months published
-    usage['publication_month'] = usage.pubdate.dt.to_period('M')
-    usage['month_only'] = pd.to_datetime(usage.month).dt.to_period('M')
-    usage['months_published'] = usage.month_only - usage.publication_month
-    usage['Months After Publication'] = usage.months_published.apply(lambda x: x.n)
+    # Number of months published
+    usage['Months After Publication'] = months_after_publication(usage.month, usage.pubdate)
 
     # Some renaming of columns for pretty graphs
     usage['Open Access'] = usage['is_oa']
@@ -199,85 +801,658 @@ def process_usage_data(usage):
     return usage
 
 
-def process_mapdata(usage):
-    world = geopandas.read_file(geopandas.datasets.get_path('naturalearth_lowres'))
-    world.at[world.name == 'Norway', 'iso_a3'] = 'NOR'
-    world.at[world.name == 'France', 'iso_a3'] = 'FRA'
-    world.at[world.name == 'United States of America', 'name'] = 'United States'
+CUBE_KEYS = ['isbn', 'iso_a3', 'is_oa', 'logged', 'month']
+
+
+def build_usage_cube(usage):
+    """Aggregate downloads to (isbn, iso_a3, is_oa, logged, month) in one pass
+
+    All of the per-country series used by the maps and tables are roll-ups of
+    this cube, so the raw usage table only needs to be scanned once per run.
+    Groups with no recorded downloads are kept as NaN (min_count=1) so that
+    dropna() on the cube behaves as it does on the raw table."""
+    cube = usage.groupby(CUBE_KEYS, dropna=False, observed=True)['downloads'].sum(min_count=1)
+    return cube.reset_index()
+
 
-    geogroupoa = usage[usage.is_oa == True].groupby('iso_a3').sum()['downloads']
-    geogroupnoa = usage[usage.is_oa == False].groupby('iso_a3').sum()['downloads']
-    world = world.set_index('iso_a3')
-    mapdata = world.join(geogroupoa)
-    mapdata = mapdata.join(geogroupnoa, rsuffix='_noa')
+def usage_cube(cube, countries=None):
+    """The usage cube in isbn order with the country ids of `countries` (see
+    country_dimension)"""
+    if not cube.isbn.is_monotonic_increasing:
+        # A GROUP BY fetch comes back in no particular order, see isbn_index
+        cube = cube.sort_values('isbn', kind='stable', ignore_index=True)
+    if countries is not None:
+        cube = cube.assign(country_id=country_ids(cube.iso_a3, countries))
+    return cube
+
+
+def usage_from_aggregates(cube, books, countries):
+    """Rebuild a usage table at the cube grain from a pre-aggregated fetch
+
+    Each row is one (isbn, iso_a3, is_oa, logged, month) cell with the book and
+    country attributes joined back on, which is all the figures read."""
+    usage = cube.merge(books, on='isbn', how='left')
+    return usage.merge(countries, on='iso_a3', how='left')
+
+
+def merge_usage_cubes(*cubes):
+    """Combine partial cubes (e.g. cached and newly fetched months) into one"""
+    return build_usage_cube(pd.concat(cubes, ignore_index=True))
+
+
+BOOK_COLUMNS = ['pubdate', 'year', 'cluster', 'category']
+COUNTRY_COLUMNS = ['country']
+
+
+def stream_usage_aggregates(chunks, fanin=STREAM_MERGE_FANIN):
+    """Usage cube, book and country tables from a usage table read in chunks
+
+    Each chunk is reduced to its partial cube and per-book / per-country
+    attributes (the same tables as a pre-aggregated fetch). The partials are
+    merged as a tree, every `fanin` partials of a level into one of the next,
+    so each cube row is re-aggregated about log(chunks) times instead of once
+    per chunk, and memory is bounded by the chunk size and fanin - 1 partials
+    per level rather than the usage table. Returns None for no chunks."""
+    levels = []
+    for chunk in chunks:
+        chunk = chunk.assign(month=month_number(chunk.month))
+        # The attributes are constant per book and country, 'first' (which
+        # skips missing values) stays on the compiled path for string columns
+        partial = (build_usage_cube(chunk),
+                   chunk.groupby('isbn', dropna=False)[BOOK_COLUMNS].first(),
+                   chunk.groupby('iso_a3', dropna=False)[COUNTRY_COLUMNS].first())
+        for level in itertools.count():
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(partial)
+            if len(levels[level]) < fanin:
+                break
+            partial = _merge_aggregates(levels[level])
+            levels[level] = []
+
+    pending = [partial for level in levels for partial in level]
+    if not pending:
+        return None
+    cube, books, countries = _merge_aggregates(pending)
+    return cube, books.reset_index(), countries.reset_index()
+
+
+def _merge_aggregates(partials):
+    # One reduction of several (cube, books, countries) partial aggregates
+    if len(partials) == 1:
+        return partials[0]
+    cubes, books, countries = zip(*partials)
+    return (merge_usage_cubes(*cubes),
+            pd.concat(books).groupby(level=0, dropna=False).first(),
+            pd.concat(countries).groupby(level=0, dropna=False).first())
+
+
+def cube_mask(cube, is_oa=None, logged=None, isbns=None):
+    """Boolean mask of the cube rows for an optional OA/logged/title selection"""
+    mask = np.ones(len(cube), dtype=bool)
+    if is_oa is not None:
+        mask &= (cube.is_oa == is_oa).values
+    if logged is not None:
+        mask &= (cube.logged == logged).values
+    if isbns is not None:
+        mask &= cube.isbn.isin(isbns).values
+    return mask
+
+
+def cube_downloads(cube, by='iso_a3', is_oa=None, logged=None, isbns=None):
+    """Sum the cube downloads by `by` for an optional OA/logged/title selection"""
+    mask = cube_mask(cube, is_oa, logged, isbns)
+    return cube[mask].groupby(by, observed=True)['downloads'].sum()
+
+
+def cube_country_downloads(cube, num_countries, is_oa=None, logged=None, isbns=None):
+    """cube_downloads by country as an array indexed by country_id
+
+    Countries without cube rows are NaN, as they are after joining the
+    cube_downloads series onto the world layer."""
+    return country_sums(cube.country_id.values, cube.downloads.values, num_countries,
+                        mask=cube_mask(cube, is_oa, logged, isbns))
+
+
+def cube_num_books(cube, is_oa=None):
+    """Number of distinct books in the cube, optionally for one OA status"""
+    if is_oa is None:
+        return cube.isbn.nunique()
+    return cube.loc[cube.is_oa == is_oa, 'isbn'].nunique()
+
+
+IsbnIndex = namedtuple('IsbnIndex', ['frame', 'isbns', 'starts', 'stops'])
+
+
+def isbn_index(df):
+    """Offset range of every book in a table whose rows are grouped by isbn
+
+    Selecting one book (book_rows) is then a slice of the table rather than
+    a boolean scan over all of it. The usage table is sorted by isbn when it
+    is loaded and the cube in usage_cube."""
+    codes, isbns = pd.factorize(df.isbn)
+    starts = np.flatnonzero(np.diff(codes, prepend=-2))
+    if len(starts) != len(isbns) + (codes == -1).any():
+        raise ValueError('The rows of each isbn must be contiguous, sort the table by isbn')
+    stops = np.append(starts[1:], len(codes))
+    found = codes[starts] >= 0
+    return IsbnIndex(df, pd.Index(np.asarray(isbns)), starts[found], stops[found])
+
+
+def book_rows(index, isbn):
+    """Rows of one book, empty if it has no usage"""
+    i = index.isbns.get_indexer([isbn])[0]
+    if i < 0:
+        return index.frame.iloc[:0]
+    return index.frame.iloc[index.starts[i]:index.stops[i]]
+
+
+BookCountries = namedtuple('BookCountries', ['matrix', 'isbns', 'countries'])
+
+
+def book_country_matrix(cube, isbns):
+    """Sparse (CSR) books x countries download matrix from the usage cube
+
+    Only the (isbn, iso_a3) pairs with usage are stored, so memory scales with
+    the number of non-zero pairs rather than books x countries. Rows follow
+    `isbns` and columns the sorted iso_a3 codes."""
+    pairs = cube.groupby(['isbn', 'iso_a3'], observed=True)['downloads'].sum()
+    rows = pd.Index(np.asarray(isbns)).get_indexer(np.asarray(pairs.index.get_level_values('isbn')))
+    cols, countries = pd.factorize(np.asarray(pairs.index.get_level_values('iso_a3')), sort=True)
+    matrix = sparse.csr_matrix((pairs.values.astype(int), (rows, cols)),
+                               shape=(len(isbns), len(countries)))
+    matrix.eliminate_zeros()
+    return BookCountries(matrix, isbns, pd.Index(countries, name='iso_a3'))
+
+
+def book_distribution(usage, cube):
+    """Per-book country distribution, built once per run
+
+    Returns a table indexed by isbn with cluster, category, OA status and the
+    country Gini coefficient scored on the sparse books x countries matrix,
+    so figure_gini and the case study share a single pivot and scoring pass."""
+    gini = usage[['isbn', 'short_cluster', 'category', 'Open Access']]
+    gini = gini.groupby('isbn', observed=True).first()
+
+    books = book_country_matrix(cube, gini.index)
+    gini['Gini Coefficient'] = gini_coefficients(books.matrix)
+
+    return gini
+
+
+def regional_effects(continents, cube, countries, regions=None):
+    """Title effect per country of every region in `continents` in one pass
+
+    For each region (by default every boolean column of continents, e.g.
+    AFRICA, LATIN_AMERICA) and its all/OA/non-OA titles: the downloads per
+    title relative to the average book, i.e. region downloads / titles /
+    corpus downloads * number of books. The titles of every region and
+    variant form one sparse selection matrix, so all the regional totals come
+    from a single product with the books x countries matrix, whose columns are
+    the country ids. Returns a frame indexed by country_id with (region,
+    downloads/downloads_oa/downloads_noa) columns, NaN where a region's titles
+    have no usage."""
+    if regions is None:
+        regions = [c for c in continents if pd.api.types.is_bool_dtype(continents[c])]
+
+    rows, isbns = pd.factorize(cube.isbn)
+    cols = cube.country_id.values
+    keep = (rows >= 0) & (cols >= 0)
+    rows, cols = rows[keep], cols[keep]
+    shape = (len(isbns), len(countries))
+    downloads = sparse.csr_matrix((np.nan_to_num(cube.downloads.values[keep].astype(float)),
+                                   (rows, cols)), shape=shape)
+    present = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+    isbns = pd.Index(np.asarray(isbns))
+
+    # One selection row per region and variant
+    titles = continents.reset_index()
+    variants = {'downloads': None, 'downloads_oa': 'yes', 'downloads_noa': 'non'}
+    columns, counts, selected = [], [], []
+    for region in regions:
+        dfregion = titles.loc[titles[region] == True]
+        for name, is_oa in variants.items():
+            rtitles = dfregion['ISBN13'] if is_oa is None else dfregion.loc[dfregion['isOA'] == is_oa, 'ISBN13']
+            found = isbns.get_indexer(rtitles.unique())
+            columns.append((region, name))
+            counts.append(rtitles.nunique())
+            selected.append(found[found >= 0])
+    lengths = [len(found) for found in selected]
+    selection = sparse.csr_matrix(
+        (np.ones(sum(lengths)), (np.repeat(np.arange(len(selected)), lengths),
+                                 np.concatenate(selected + [np.array([], dtype=int)]))),
+        shape=(len(selected), len(isbns)))
+
+    region_downloads = (selection @ downloads).toarray()
+    region_downloads[(selection @ present).toarray() == 0] = np.nan
+
+    mapall = cube_country_downloads(cube, len(countries))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        effects = (region_downloads / np.array(counts)[:, None] / mapall * cube_num_books(cube))
+    return pd.DataFrame(effects.T, index=countries.index,
+                        columns=pd.MultiIndex.from_tuples(columns))
+
+
+def process_mapdata(cube, world, countries):
+    mapdata = country_join(world, {
+        'downloads': cube_country_downloads(cube, len(countries), is_oa=True),
+        'downloads_noa': cube_country_downloads(cube, len(countries), is_oa=False),
+    })
     mapdata['downloads'] = mapdata.downloads.fillna(1)
     mapdata['downloads_noa'] = mapdata.downloads_noa.fillna(1)
     mapdata['Total OA Book Downloads'] = mapdata.downloads
     mapdata['Total Non-OA Book Downloads'] = mapdata.downloads_noa
 
-    num_oa_books = usage[usage.is_oa == True]['isbn'].nunique()
-    num_noa_books = usage[usage.is_oa == False]['isbn'].nunique()
+    num_oa_books = cube_num_books(cube, is_oa=True)
+    num_noa_books = cube_num_books(cube, is_oa=False)
     mapdata['Average downloads per OA book'] = mapdata.downloads / num_oa_books
     mapdata['Average downloads per non-OA book'] = mapdata.downloads_noa / num_noa_books
 
-    return mapdata, world
+    return mapdata
+
+
+#############
+# World Map #
+#############
+
+WORLD_CACHE_DIR = '.world_cache'
+WORLD_SOURCE = None  # None for the Natural Earth low-res layer shipped with geopandas
+
+# Digest of the source file of the world layer loaded last, see load_world
+_world_cache_key = None
+
+
+def load_world(source=None, cache_dir=WORLD_CACHE_DIR):
+    """Natural Earth world layer with the iso_a3 and name corrections applied
+
+    The corrected layer is cached as GeoParquet, together with the polygon
+    paths used by map_compare, under a key derived from the source file's
+    contents. Later runs load the cache instead of parsing the shapefile.
+    Each row carries a geom_id into the cached paths."""
+    global _world_cache_key
+
+    source = world_source(source)
+    key = file_digest(source)
+    cached_filepath = os.path.join(cache_dir, f'world_{key}.parquet')
+    if os.path.exists(cached_filepath):
+        _world_cache_key = key
+        return geopandas.read_parquet(cached_filepath)
+
+    world = geopandas.read_file(source)
+    world.loc[world.name == 'Norway', 'iso_a3'] = 'NOR'
+    world.loc[world.name == 'France', 'iso_a3'] = 'FRA'
+    world.loc[world.name == 'United States of America', 'name'] = 'United States'
+    world['geom_id'] = np.arange(len(world))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    world.to_parquet(cached_filepath)
+    write_world_paths(world, key, cache_dir=cache_dir)
+    _world_cache_key = key
+    return world
+
+
+def world_source(source=None):
+    return source or WORLD_SOURCE or geopandas.datasets.get_path('naturalearth_lowres')
+
+
+def world_digest():
+    """Key of the world layer load_world reads: the digest of its source files
+    and the geopandas version that parses them"""
+    return f'{file_digest(world_source())} geopandas {geopandas.__version__}'
+
+
+def file_digest(filepath):
+    """SHA-256 of a file and its shapefile siblings (.shx, .dbf, .prj, ...)"""
+    stem, _ = os.path.splitext(os.path.abspath(filepath))
+    directory = os.path.dirname(stem)
+    siblings = sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                      if os.path.splitext(os.path.join(directory, f))[0] == stem)
+    digest = hashlib.sha256()
+    for sibling in siblings:
+        with open(sibling, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def _world_paths_prefix(key, simplify, cache_dir):
+    resolution = 'full' if simplify is None else f'simplify{simplify:g}'
+    return os.path.join(cache_dir, f'world_{key}_{resolution}')
+
+
+def write_world_paths(world, key, simplify=None, cache_dir=WORLD_CACHE_DIR):
+    """Flatten the world polygons into matplotlib path arrays on disk
+
+    Every ring becomes MOVETO, LINETO..., CLOSEPOLY; the rings of a geometry are
+    contiguous and offsets.npy marks where each geom_id starts. With
+    `simplify` the polygons are simplified (in degrees) first, for small maps."""
+    geometries = world.geometry if simplify is None else world.geometry.simplify(simplify)
+    vertices, codes, offsets = [], [], [0]
+    for geometry in geometries:
+        polygons = [] if geometry is None else getattr(geometry, 'geoms', [geometry])
+        length = 0
+        for polygon in polygons:
+            for ring in [polygon.exterior, *polygon.interiors]:
+                coords = np.asarray(ring.coords, dtype=float)[:, :2]
+                if len(coords) < 3:
+                    continue
+                ring_codes = np.full(len(coords), Path.LINETO, dtype=np.uint8)
+                ring_codes[0] = Path.MOVETO
+                ring_codes[-1] = Path.CLOSEPOLY
+                vertices.append(coords)
+                codes.append(ring_codes)
+                length += len(coords)
+        offsets.append(offsets[-1] + length)
+
+    prefix = _world_paths_prefix(key, simplify, cache_dir)
+    np.save(prefix + '_vertices.npy', np.concatenate(vertices))
+    np.save(prefix + '_codes.npy', np.concatenate(codes))
+    np.save(prefix + '_offsets.npy', np.array(offsets, dtype=np.int64))
+    np.save(prefix + '_bounds.npy', np.asarray(world.geometry.bounds, dtype=float))
+
+
+def world_paths(simplify=None, cache_dir=WORLD_CACHE_DIR):
+    """Memory-mapped paths of the world layer loaded last, indexed by geom_id
+
+    Returns (paths, bounds) or None when no world layer has been cached."""
+    if _world_cache_key is None:
+        return None
+    return _load_world_paths(_world_cache_key, simplify, cache_dir)
+
+
+@lru_cache(maxsize=None)
+def _load_world_paths(key, simplify, cache_dir):
+    prefix = _world_paths_prefix(key, simplify, cache_dir)
+    if not os.path.exists(prefix + '_offsets.npy'):
+        world = geopandas.read_parquet(os.path.join(cache_dir, f'world_{key}.parquet'))
+        write_world_paths(world, key, simplify=simplify, cache_dir=cache_dir)
+
+    vertices = np.load(prefix + '_vertices.npy', mmap_mode='r')
+    codes = np.load(prefix + '_codes.npy', mmap_mode='r')
+    offsets = np.load(prefix + '_offsets.npy')
+    bounds = np.load(prefix + '_bounds.npy')
+    paths = [Path(vertices[start:end], codes[start:end])
+             for start, end in zip(offsets[:-1], offsets[1:])]
+    return paths, bounds
+
+
+#####################
+# Country Dimension #
+#####################
+
+def country_dimension(cube):
+    """Countries with a dense integer country_id, and the world layer carrying it
+
+    The country_id of a code is its row in the table: the codes of the
+    corrected world layer (see load_world) in layer order, then the codes only
+    seen in the usage cube. Per-country aggregates are then arrays of length
+    len(countries) indexed by country_id (see country_sums), which are looked
+    up onto the map with country_join instead of joining on iso_a3 strings.
+    Returns (countries, world), the world layer indexed by iso_a3."""
+    world = load_world()
+
+    codes = pd.Index(world.iso_a3.unique())
+    if isinstance(cube.iso_a3.dtype, pd.CategoricalDtype):
+        seen = cube.iso_a3.cat.categories
+    else:
+        seen = cube.iso_a3.dropna().unique()
+    codes = codes.append(pd.Index(seen).difference(codes))
+
+    first = world.drop_duplicates('iso_a3').set_index('iso_a3')
+    countries = pd.DataFrame({
+        'iso_a3': np.asarray(codes, dtype=object),
+        'name': first.name.reindex(codes).values,
+        'continent': first.continent.reindex(codes).values,
+        'in_world': codes.isin(first.index),
+    }, index=pd.RangeIndex(len(codes), name='country_id'))
+
+    world = world.assign(country_id=country_ids(world.iso_a3, countries))
+    return countries, world.set_index('iso_a3')
+
+
+def country_ids(iso_a3, countries):
+    """country_id of each code in a column of iso_a3 codes, -1 if missing or unknown"""
+    codes = pd.Index(countries.iso_a3)
+    if isinstance(iso_a3.dtype, pd.CategoricalDtype):
+        # Look up each category once, -1 category codes (missing) hit the sentinel
+        lookup = np.append(codes.get_indexer(iso_a3.cat.categories), -1)
+        return lookup[iso_a3.cat.codes.values].astype('int32')
+    return codes.get_indexer(iso_a3).astype('int32')
+
+
+def country_counts(ids, num_countries, mask=None):
+    """Number of rows per country_id, optionally of the rows in `mask`"""
+    keep = ids >= 0
+    if mask is not None:
+        keep &= mask
+    return np.bincount(ids[keep], minlength=num_countries)
+
+
+def country_sums(ids, values, num_countries, mask=None):
+    """Sum of `values` per country_id, NaN for countries without rows
+
+    Missing values count as zero, as in a groupby sum."""
+    keep = ids >= 0
+    if mask is not None:
+        keep &= mask
+    values = np.nan_to_num(np.asarray(values, dtype=float)[keep])
+    sums = np.bincount(ids[keep], weights=values, minlength=num_countries)
+    return np.where(np.bincount(ids[keep], minlength=num_countries) > 0, sums, np.nan)
+
+
+def country_values(ids, values, num_countries):
+    """Array indexed by country_id from one value per country, NaN for the others"""
+    keep = ids >= 0
+    result = np.full(num_countries, np.nan)
+    result[ids[keep]] = np.asarray(values, dtype=float)[keep]
+    return result
+
+
+def country_join(world, columns):
+    """The world layer with per-country arrays (or a frame indexed by
+    country_id) looked up as columns by each row's country_id"""
+    ids = world.country_id.values
+    return world.assign(**{name: np.asarray(values)[ids] for name, values in columns.items()})
 
 
 ###############################
 # Processing and Figures Main #
 ###############################
 
-def plot_figures(af):
-    """Main plotting and processing function"""
-
+def plot_figures(af,
+                 cache_format=CACHE_FORMAT,
+                 usage_filters=None,
+                 render_workers=None,
+                 figure_cache=FIGURE_CACHE_DIR,
+                 streaming=False,
+                 chunksize=STREAM_CHUNKSIZE,
+                 profile=False,
+                 cprofile_dir=None):
+    """Main plotting and processing function
+
+    With streaming the usage table is never loaded in full: it is read in
+    chunks of `chunksize` rows and reduced to the usage cube, and the figures
+    work from the cube grain table as they do for a pre-aggregated cache.
+    With profile every stage is timed and the run profile is written next to
+    text_data.json (see RunProfile), with cprofile_dir also as cProfile dumps.
+
+    The figures render on render_workers forked processes (all cores by
+    default). The data several of them read is loaded before the fork and
+    held until they are done, the rest is loaded by the worker rendering the
+    figure that reads it and dropped after it. render_workers=1 renders one
+    figure at a time and releases every table as soon as no remaining figure
+    reads it, which gives the lowest peak memory and the earliest first
+    figure at the cost of the parallel rendering."""
+    run_profile = RunProfile(cprofile_dir) if profile else None
+    with run_profile or nullcontext():
+        _plot_figures(af, cache_format, usage_filters, render_workers, figure_cache,
+                      streaming, chunksize)
+        if run_profile:
+            run_profile.write(af)
+
+
+def _plot_figures(af, cache_format, usage_filters, render_workers, figure_cache,
+                  streaming, chunksize):
     sns.set_palette(coard)
 
-    # Load and collect the cached data
-    store_filepath = af.path_to_cached_file(
-        HDF5_CANONICAL_FILENAME, "get_data")
-    print('Loading data from:', store_filepath)
-
-    # Load data to data frames
-    with pd.HDFStore(store_filepath) as store:
-        usage = store['usage']
-        cites = store['cites']
-        webo = store['webo']
-        continents = store['continents']
-        normal = store['normal']
-        chapters = store['chapters']
-        tld = store['tld']
-
-    # Data processing
-    usage = process_usage_data(usage)
-    mapdata, world = process_mapdata(usage)
-
-    tld_bar(af, tld, usage)
-    # Generate figures and in-text data
-    in_text_data(af, usage, cites, world, tld)
-    figure_comparisons(af, usage, cites, webo)
-    figure_downloads_by_time(af, usage)
-    figure_gini(af, usage)
-    # Testing Jointplot
-    scatter_chapters(af, usage, chapters)
-    tld_bar(af, tld, usage)
-    tld_table(af, tld)
-
-    # Generate the maps
-    map_oa_noa(af, mapdata)
-    av_downloads(af, usage, world)
-    anonymous_where_no_logged(af, usage, world)
-    anon_v_logged(af, usage, world)
-    africa_title_effect(af, usage, continents, world)
-    latam_title_effect(af, usage, continents, world)
-    usage_normal_by_pubs(af, usage, world, normal)
-
-    # Run the case study code on Digital Kenya
-    case_study('978-1-137-57878-5', usage, world, af)
+    data = load_figure_data(af, cache_format, usage_filters, streaming, chunksize)
+
+    # Generate the figures, maps, in-text data and case study. The tables are
+    # loaded and the processed usage, maps and per-book distribution derived
+    # on demand (see DATA_NODES), only for figures whose inputs or code have
+    # changed
+    render_figures(af, data, workers=render_workers, cache_dir=figure_cache)
+    data.report_loads()
 
     # Add the additional map figure generated in R
     af.add_existing_file("assets/city-Digital_Kenya_v2.png")
 
 
+def load_figure_data(af, cache_format=CACHE_FORMAT, usage_filters=None, streaming=False,
+                     chunksize=STREAM_CHUNKSIZE):
+    """The cached tables the figures read, as FigureData (see plot_figures)
+
+    No table is read here: each is loaded the first time a figure (or the
+    data derived for one) asks for it, and is keyed for the figure cache by
+    the cache files it is read from, so cached figures never load it. The
+    usage cube is loaded on its own where the cache holds one that applies,
+    so the figures that only read the cube never load the usage table."""
+    usage_tables = ['usage', 'usage_cube', 'books', 'countries']
+    usage_key = cached_tables_key(af, usage_tables, cache_format, columns=CACHE_COLUMNS['usage'],
+                                  filters=usage_filters, streaming=streaming)
+    if streaming:
+        loaders = [(['usage_table', 'usage_cube'],
+                    partial(stream_usage_tables, af, cache_format, usage_filters, chunksize),
+                    usage_key)]
+    else:
+        loaders = [(['usage_table'],
+                    partial(load_usage_tables, af, cache_format, usage_filters, chunksize),
+                    usage_key),
+                   (['usage_cube'],
+                    partial(load_cached_cube, af, cache_format, usage_filters),
+                    cached_tables_key(af, ['usage_cube'], cache_format, filters=usage_filters))]
+    for name in ['cites', 'webo', 'continents', 'normal', 'chapters', 'tld']:
+        # Only the columns the figures use
+        loaders.append(([name],
+                        partial(load_cached_table, af, name, cache_format,
+                                columns=CACHE_COLUMNS[name]),
+                        cached_tables_key(af, [name], cache_format, columns=CACHE_COLUMNS[name])))
+    return FigureData(loaders=loaders)
+
+
+def load_usage_tables(af, cache_format=CACHE_FORMAT, usage_filters=None,
+                      chunksize=STREAM_CHUNKSIZE):
+    """The usage table, sorted by isbn"""
+    usage = load_usage_table(af, cache_format, CACHE_COLUMNS['usage'], usage_filters, chunksize)
+    if usage is None:
+        usage = load_aggregated_usage(af, cache_format, usage_filters)
+    return usage.sort_values('isbn', kind='stable', ignore_index=True)
+
+
+def stream_usage_tables(af, cache_format=CACHE_FORMAT, usage_filters=None,
+                        chunksize=STREAM_CHUNKSIZE):
+    """The usage table at the cube grain and the usage cube, reduced from the
+    usage table read in chunks (see stream_usage_aggregates)"""
+    with profile_stage('stream usage') as stage:
+        streamed = stream_usage_aggregates(
+            iter_cached_table(af, 'usage', cache_format, columns=CACHE_COLUMNS['usage'],
+                              filters=usage_filters, chunksize=chunksize))
+        stage['rows'] = streamed and len(streamed[0])
+    if streamed is None:
+        usage = load_aggregated_usage(af, cache_format, usage_filters)
+        return (usage.sort_values('isbn', kind='stable', ignore_index=True),
+                load_cached_cube(af, cache_format, usage_filters))
+    usage = apply_usage_schema(usage_from_aggregates(*streamed))
+    usage = usage.sort_values('isbn', kind='stable', ignore_index=True)
+    return usage, apply_usage_schema(streamed[0].copy())
+
+
+def load_aggregated_usage(af, cache_format=CACHE_FORMAT, usage_filters=None):
+    # The cache was written by a pre-aggregated fetch
+    usage = usage_from_aggregates(load_cached_table(af, 'usage_cube', cache_format),
+                                  load_cached_table(af, 'books', cache_format),
+                                  load_cached_table(af, 'countries', cache_format))
+    if usage_filters:
+        usage = usage[_filters_mask(usage, usage_filters)]
+    return apply_usage_schema(usage)
+
+
+def load_cached_cube(af, cache_format=CACHE_FORMAT, usage_filters=None):
+    """The usage cube stored with the cache, None if there is none or the
+    usage is filtered, which it does not apply to"""
+    if usage_filters is not None:
+        return None
+    cube = load_cached_table(af, 'usage_cube', cache_format, missing_ok=True)
+    return cube if cube is None else apply_usage_schema(cube)
+
+
+def load_usage_table(af, cache_format=CACHE_FORMAT, columns=None, filters=None,
+                     chunksize=STREAM_CHUNKSIZE):
+    """The cached usage table with apply_usage_schema applied as it is read
+
+    The string columns are never all held as Python strings at once: the
+    Parquet cache decodes them straight to categoricals and the HDF5 store is
+    converted chunk by chunk (a usage table cached in fixed format is read in
+    full). Returns None if the cache does not hold a usage table."""
+    if cache_format == 'parquet':
+        usage = load_cached_table(af, 'usage', cache_format, columns, filters, missing_ok=True,
+                                  categories=[c for c in USAGE_CATEGORIES + ['month']
+                                              if columns is None or c in columns])
+        chunks = [] if usage is None else [apply_usage_schema(usage)]
+    else:
+        with profile_stage('load usage') as stage:
+            try:
+                chunks = [apply_usage_schema(chunk) for chunk in
+                          iter_cached_table(af, 'usage', cache_format, columns, filters, chunksize)]
+            except ValueError as e:
+                print(e)
+                chunks = [apply_usage_schema(load_cached_table(af, 'usage', cache_format,
+                                                               columns, filters))]
+            stage['rows'] = sum(len(chunk) for chunk in chunks)
+    if not chunks:
+        return None
+
+    # Sorted categories, as astype('category') gives for the table read in
+    # full, shared by all chunks so that they concatenate as categoricals
+    for column in USAGE_CATEGORIES:
+        if column in chunks[0]:
+            categories = pd.Index([])
+            for chunk in chunks:
+                categories = categories.union(chunk[column].cat.categories)
+            for chunk in chunks:
+                chunk[column] = chunk[column].cat.set_categories(categories.sort_values())
+    return chunks[0] if len(chunks) == 1 else pd.concat(chunks, ignore_index=True)
+
+
+def cached_tables_key(af, names, cache_format=CACHE_FORMAT, **options):
+    """Digest of the cache files holding `names` and the options they are
+    read with, standing in for the digest of the loaded tables"""
+    if cache_format == 'hdf5':
+        filepaths = [af.path_to_cached_file(HDF5_CANONICAL_FILENAME, "get_data")]
+    else:
+        filepaths = [af.path_to_cached_file(PARQUET_CACHE_TEMPLATE.format(name), "get_data")
+                     for name in names]
+    parts = [cache_format, repr(names), repr(sorted(options.items()))]
+    parts += [cache_file_digest(filepath) for filepath in filepaths]
+    return hashlib.sha256(' '.join(parts).encode()).hexdigest()
+
+
+def cache_file_digest(filepath):
+    """Hash of the path, size and mtime of a cache file, or of every file of a
+    partitioned Parquet directory, '' if it does not exist
+
+    The files are not read: get_data rewrites the cache whenever it changes,
+    which gives the files a new mtime."""
+    if os.path.isdir(filepath):
+        filepaths = sorted(os.path.join(root, f) for root, _, files in os.walk(filepath) for f in files)
+    else:
+        filepaths = [filepath] if os.path.exists(filepath) else []
+    if not filepaths:
+        return ''
+    stats = [(os.path.abspath(f), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in filepaths]
+    return hashlib.sha256(repr(stats).encode()).hexdigest()
+
+
 ################
 # In text data #
 ################
@@ -300,58 +1475,65 @@ def times(ratio):
         return f"{int(ratio - 1 * 100)}% more"
 
 
-def in_text_data(af, usage, cites, world, tld):
+def in_text_data(af, usage, cites, countries, tld):
     d = {}
 
-    num_oa = usage[usage.is_oa == True].isbn.nunique()
-    num_closed = usage[usage.is_oa == False].isbn.nunique()
+    # One grouped pass over the usage table, every statistic below is a
+    # roll-up of these (is_oa, logged, iso_a3, isbn) cells
+    cells = usage.groupby(['is_oa', 'logged', 'iso_a3', 'isbn'], dropna=False, observed=True)
+    cells = cells['downloads'].sum().reset_index()
+    oa = cells[cells.is_oa == True]
+    closed = cells[cells.is_oa == False]
+
+    num_oa = oa.isbn.nunique()
+    num_closed = closed.isbn.nunique()
     ratio = num_closed / num_oa
 
     d['num_oa'] = "{:,}".format(num_oa)
     d['num_closed'] = "{:,}".format(num_closed)
     d['ratio'] = ratio
 
-    oa_downloads = usage[usage.is_oa == True].downloads.sum()
-    closed_downloads = usage[usage.is_oa == False].downloads.sum()
+    oa_downloads = oa.downloads.sum()
+    closed_downloads = closed.downloads.sum()
 
     d['oa_downloads'] = "{:,}".format(oa_downloads)
     d['closed_downloads'] = "{:,}".format(closed_downloads)
     d['oa_times_more_downloads'] = num2words(np.round((oa_downloads / closed_downloads * ratio)))
 
-    downloads = usage.groupby(['is_oa', 'isbn'])
-    downloads = downloads.agg(
-        downloads=pd.NamedAgg(column='downloads', aggfunc='sum')
-    )
-    downloads.reset_index(inplace=True)
-    tempdata = pd.merge(downloads, cites, on='isbn')
+    books = cells[['is_oa', 'isbn']].dropna().drop_duplicates()
+    tempdata = pd.merge(books, cites, on='isbn')
 
     oa_cites = int(tempdata[tempdata.is_oa == True].Citations.sum())
     closed_cites = int(tempdata[tempdata.is_oa == False].Citations.sum())
 
     d['oa_times_more_citations'] = times(oa_cites / closed_cites * ratio)
 
-    bycountry = usage.groupby(['iso_a3', 'logged']).agg(
-        downloads=pd.NamedAgg(column='downloads', aggfunc='sum')
-    )
-    bycountry.reset_index(inplace=True)
-    bycountry = pd.merge(bycountry, world, on='iso_a3')
-
-    all_cids = bycountry.iso_a3.unique()
-    anon_cids = bycountry[(bycountry.logged == False) &
-                          (bycountry.downloads > 0)]['iso_a3'].unique()
-    logged_cids = bycountry[(bycountry.logged == True) &
-                            (bycountry.downloads > 0)]['iso_a3'].unique()
-    anon_only = set(anon_cids) & (set(all_cids) - set(logged_cids))
-
-    d['countries_with_anon_but_not_logged_usage'] = int(len(anon_only))
-    d['new_countries_in_africa'] = len(bycountry[(bycountry.iso_a3.isin(anon_only)) &
-                                                 (bycountry.continent == "Africa")])
-
-    new_countries_total_downloads = bycountry[bycountry.iso_a3.isin(anon_only)].downloads.sum()
+    # Anonymous and logged downloads of the world layer's countries, as
+    # arrays indexed by country_id, from the cells rather than the usage rows
+    num_countries = len(countries)
+    ids = country_ids(cells.iso_a3, countries)
+    is_anon = (cells.logged == False).values
+    is_logged = (cells.logged == True).values
+    anon_rows = country_counts(ids, num_countries, mask=is_anon)
+    logged_rows = country_counts(ids, num_countries, mask=is_logged)
+    anon_downloads = country_sums(ids, cells.downloads.values, num_countries, mask=is_anon)
+    logged_downloads = country_sums(ids, cells.downloads.values, num_countries, mask=is_logged)
+
+    anon_only = countries.in_world.values & (anon_downloads > 0) & ~(logged_downloads > 0)
+    in_africa = (countries.continent == "Africa").values
+
+    d['countries_with_anon_but_not_logged_usage'] = int(anon_only.sum())
+    # Counted per (country, logged) pair with usage, as the rows of a by-country table
+    d['new_countries_in_africa'] = int(((anon_rows > 0).astype(int) + (logged_rows > 0))[
+        anon_only & in_africa].sum())
+
+    # Sentinel for the -1 id of unknown countries
+    new_countries_rows = np.append(anon_only, False)[ids] & (is_anon | is_logged)
+    new_countries_total_downloads = cells.downloads[new_countries_rows].sum()
     d['new_countries_total_downloads'] = "{:,}".format(new_countries_total_downloads)
     d['new_countries_downloads_pc'] = int(np.round(new_countries_total_downloads /
-                                                   usage[
-                                                       usage.logged == False
+                                                   cells[
+                                                       cells.logged == False
                                                        ].downloads.sum() * 100,
                                                    decimals=0))
 
@@ -363,8 +1545,8 @@ def in_text_data(af, usage, cites, world, tld):
     d['oa_pc_increase_sites'] = int(np.round((tld.OATotal.sum() / tld.nonOATotal.sum() *
                                               100 * ratio - 100), decimals=0))
 
-    d['num_countries_oa_books'] = int(usage[usage.is_oa == True].iso_a3.nunique())
-    d['num_countries_noa_books'] = int(usage[usage.is_oa == False].iso_a3.nunique())
+    d['num_countries_oa_books'] = int(oa.iso_a3.nunique())
+    d['num_countries_noa_books'] = int(closed.iso_a3.nunique())
 
     for f in af.generate_file('text_data.json'):
         json.dump(d, f)
@@ -376,11 +1558,11 @@ def in_text_data(af, usage, cites, world, tld):
 
 def figure_comparisons(af, usage, cites, webo):
     # Data Processing
-    downloads = usage.groupby(['Open Access', 'isbn'])
+    downloads = usage.groupby(['Open Access', 'isbn'], observed=True)
     downloads = downloads.agg(
         downloads=pd.NamedAgg(column='downloads', aggfunc='sum'),
-        short_cluster=pd.NamedAgg(column='short_cluster', aggfunc='max'),
-        category=pd.NamedAgg(column='category', aggfunc='max'))
+        short_cluster=pd.NamedAgg(column='short_cluster', aggfunc='first'),
+        category=pd.NamedAgg(column='category', aggfunc='first'))
     downloads.reset_index(inplace=True)
 
     # To make the y-scales comparable between metrics
@@ -393,28 +1575,34 @@ def figure_comparisons(af, usage, cites, webo):
                            value_vars=['Downloads', 'Citations', 'Domains'],
                            value_name='Metric')
 
+    # Confidence intervals of the metric means, the panel b ones are exported only
+    cis = bootstrap_ci(figmelt, 'Metric', ['variable', 'Open Access'])
+    facet_ci_table = bootstrap_ci(figmelt, 'Metric',
+                                  ['variable', 'short_cluster', 'category', 'Open Access'])
+    export_cis(af, 'figure1_ci.csv', {'a': cis, 'b': facet_ci_table})
+
     # Plot the panels
     panela = top_panel(sns.barplot,
                        figmelt,
-                       'variable', 'Metric')
+                       'variable', 'Metric', ci=None)
+    ci_errorbars(panela.ax, cis, 'variable', order=list(figmelt.variable.unique()))
     panela.set_axis_labels(x_var='', y_var='Number (Downloads in 1000s)')
-    panela.savefig('figure1a.png', bbox_inches='tight', dpi=300)
-    af.add_existing_file('figure1a.png', remove=True)
+    panela = panel_image(panela, dpi=300)
     plt.close()
 
     panelb = grid_panel(sns.barplot,
                         figmelt,
                         'variable', 'Metric', ci=None)
     panelb.set_axis_labels(x_var='', y_var='')
-    panelb.savefig('figure1b.png', bbox_inches='tight', dpi=300)
-    af.add_existing_file('figure1b.png', remove=True)
+    panelb = panel_image(panelb, dpi=300)
     plt.close()
-    combine_panels(af, 'figure1a.png', 'figure1b.png', 'figure1full.png')
+    combine_panels(af, panela, panelb, 'figure1full.png')
 
 
 def figure_downloads_by_time(af, usage):
     # Group and calculate summary statistics
-    groups = usage.groupby(['short_cluster', 'category', 'Months After Publication', 'Open Access'])
+    groups = usage.groupby(['short_cluster', 'category', 'Months After Publication', 'Open Access'],
+                           observed=True)
     grouped = groups.agg(
         downloads=pd.NamedAgg(column='downloads', aggfunc='sum'),
         num_books=pd.NamedAgg(column='isbn', aggfunc='nunique')
@@ -422,65 +1610,58 @@ def figure_downloads_by_time(af, usage):
     grouped['Downloads per Book'] = grouped.downloads / grouped.num_books
     grouped.reset_index(inplace=True)
 
+    # Confidence band of the summary panel, over the clusters and categories
+    cis = bootstrap_ci(grouped, 'Downloads per Book', ['Months After Publication', 'Open Access'])
+    export_cis(af, 'figure2_ci.csv', {'a': cis})
+
     # Summary Panel
     panela = top_panel(sns.lineplot,
                        grouped,
                        'Months After Publication', 'Downloads per Book',
                        xlim=(-2, 40), ylim=(10, 20000),
-                       linewidth=3)
+                       linewidth=3, ci=None)
+    ci_bands(panela.ax, cis, 'Months After Publication')
     panela.set(yscale='log')
-    panela.savefig('figure2a.png', bbox_inches='tight', dpi=300)
-    af.add_existing_file('figure2a.png', remove=True)
+    panela = panel_image(panela, dpi=300)
     plt.close()
 
-    # Main Panel
+    # Main Panel, one value per point so there is no interval to draw
     panelb = grid_panel(sns.lineplot,
                         grouped,
                         'Months After Publication', 'Downloads per Book',
                         xlim=(-2, 40), ylim=(10, 20000),
-                        linewidth=3)
+                        linewidth=3, ci=None)
     panelb.set(yscale='log')
-    panelb.savefig('figure2b.png', bbox_inches='tight', dpi=300)
-    af.add_existing_file('figure2b.png', remove=True)
+    panelb = panel_image(panelb, dpi=300)
     plt.close()
-    combine_panels(af, 'figure2a.png', 'figure2b.png', 'figure2full.png')
+    combine_panels(af, panela, panelb, 'figure2full.png')
 
 
-def figure_gini(af, usage):
-    # Process Data
-    countries = usage.groupby(['isbn', 'Open Access', 'iso_a3']).sum()['downloads']
-    countries = countries.unstack('iso_a3', fill_value=0)
-    countries = countries.sort_index(level=0)
-    gini = usage[['isbn', 'short_cluster', 'category', 'Open Access']]
-    gini = gini.groupby('isbn').first()
-    gini.reset_index(inplace=True)
-    gini.sort_values('isbn')
-    cort = countries.reset_index().sort_values('isbn')
-    del cort['Open Access']
-    cort = cort.set_index(cort.isbn)
-    del cort['isbn']
-    cort = cort.values.astype(int)
-    gini['Gini Coefficient'] = np.array([ineq(x) for x in cort])
+def figure_gini(af, gini):
+    # Confidence intervals of the mean Gini coefficients
+    cis = bootstrap_ci(gini, 'Gini Coefficient', ['Open Access'])
+    facet_ci_table = bootstrap_ci(gini, 'Gini Coefficient', ['short_cluster', 'category', 'Open Access'])
+    export_cis(af, 'figure_gini_ci.csv', {'a': cis, 'b': facet_ci_table})
 
     # Plot the Panels
     panela = top_panel(sns.barplot,
                        gini,
                        'Open Access', 'Gini Coefficient',
                        ylim=(0.70, 0.95),
-                       hue=None, order=[True, False])
-    panela.savefig('figure_gini_a.png', bbox_inches='tight', dpi=300)
-    af.add_existing_file('figure_gini_a.png', remove=True)
+                       hue=None, order=[True, False], ci=None)
+    ci_errorbars(panela.ax, cis, 'Open Access', order=[True, False], hue=None)
+    panela = panel_image(panela, dpi=300)
     plt.close()
 
     panelb = grid_panel(sns.barplot,
                         gini,
                         'Open Access', 'Gini Coefficient',
                         ylim=(0.80, 0.95),
-                        hue=None, order=[True, False])
-    panelb.savefig('figure_gini_b.png', bbox_inches='tight', dpi=300)
-    af.add_existing_file('figure_gini_b.png', remove=True)
+                        hue=None, order=[True, False], ci=None)
+    facet_cis(panelb, facet_ci_table, ci_errorbars, x='Open Access', order=[True, False], hue=None)
+    panelb = panel_image(panelb, dpi=300)
     plt.close()
-    combine_panels(af, 'figure_gini_a.png', 'figure_gini_b.png', 'figure_gini_full.png')
+    combine_panels(af, panela, panelb, 'figure_gini_full.png')
 
 
 def ineq(arr):
@@ -494,8 +1675,54 @@ def ineq(arr):
     return coef_ * weighted_sum / (sorted_arr.sum()) - const_
 
 
+def gini_coefficients(matrix):
+    """Gini coefficient of every row of a books x countries download matrix
+
+    Batched version of ineq(): the rows are sorted and weighted by rank in one
+    NumPy pass instead of a Python loop per book. Accepts a dense array or a
+    scipy.sparse matrix and returns the same coefficients as ineq()."""
+    if sparse.issparse(matrix):
+        return _sparse_gini_coefficients(matrix)
+
+    sorted_arr = np.sort(np.asarray(matrix), axis=1)
+    n = sorted_arr.shape[1]
+    weighted_sum = sorted_arr @ np.arange(1, n + 1)
+    return _gini_from_sums(weighted_sum, sorted_arr.sum(axis=1), n)
+
+
+def _sparse_gini_coefficients(matrix):
+    # Only the stored values need sorting, the implicit zeros of a row take
+    # the lowest ranks and contribute nothing to the weighted sum
+    csr = sparse.csr_matrix(matrix, copy=True)
+    csr.sum_duplicates()
+    num_rows, n = csr.shape
+    nnz = np.diff(csr.indptr)
+    rows = np.repeat(np.arange(num_rows), nnz)
+    order = np.lexsort((csr.data, rows))
+    data = csr.data[order]
+
+    position = np.arange(data.size) - csr.indptr[rows]
+    ranks = n - nnz[rows] + position + 1
+
+    # Rows are contiguous in CSR order so the sums are segment reductions,
+    # kept in the input dtype so integer downloads are summed exactly
+    starts = csr.indptr[:-1][nnz > 0]
+    weighted_sum = np.zeros(num_rows, dtype=np.result_type(data, ranks))
+    weighted_sum[nnz > 0] = np.add.reduceat(data * ranks, starts)
+    totals = np.zeros(num_rows, dtype=weighted_sum.dtype)
+    totals[nnz > 0] = np.add.reduceat(data, starts)
+    return _gini_from_sums(weighted_sum, totals, n)
+
+
+def _gini_from_sums(weighted_sum, totals, n):
+    coef_ = 2. / n
+    const_ = (n + 1.) / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return coef_ * weighted_sum / totals - const_
+
+
 def scatter_chapters(af, usage, chapters):
-    downloads = usage.groupby(['Open Access', 'isbn'])
+    downloads = usage.groupby(['Open Access', 'isbn'], observed=True)
     downloads = downloads.agg(
         downloads=pd.NamedAgg(column='downloads', aggfunc='sum'),
         months_published=pd.NamedAgg(column='month', aggfunc='nunique')
@@ -511,7 +1738,7 @@ def scatter_chapters(af, usage, chapters):
                                     data=figdata,
                                     )
     downloadsvchapters.set(xscale='log', yscale='log')
-    downloadsvchapters.savefig('chapters_usage_scatter.png')
+    save_figure(downloadsvchapters, 'chapters_usage_scatter.png')
     af.add_existing_file('chapters_usage_scatter.png', remove=True)
     plt.close()
 
@@ -527,7 +1754,7 @@ def scatter_chapters(af, usage, chapters):
                                  )
 
     downloadsvpages.set(xscale='log', yscale='log')
-    downloadsvpages.savefig('pages_usage_scatter.png')
+    save_figure(downloadsvpages, 'pages_usage_scatter.png')
     af.add_existing_file('pages_usage_scatter.png', remove=True)
     plt.close()
 
@@ -569,12 +1796,12 @@ def tld_table(af, tld):
         json.dump(table, f)
 
 
-def tld_bar(af, tld, usage):
+def tld_bar(af, tld, cube):
     tempdata = tld[tld.rankOA < 11].sort_values('OATotal', ascending=False)
     tempdata = tempdata.to_dict('records')
 
-    num_oabooks = usage[usage.is_oa == True].isbn.nunique()
-    num_nonoabooks = usage[usage.is_oa == False].isbn.nunique()
+    num_oabooks = cube_num_books(cube, is_oa=True)
+    num_nonoabooks = cube_num_books(cube, is_oa=False)
     dflist = []
     for row in tempdata:
         da = {}
@@ -593,7 +1820,7 @@ def tld_bar(af, tld, usage):
     panel = sns.barplot(x='Top Level Domain', y='Number of sites per book',
                         hue='Open Access', hue_order=[True, False], palette=['#00DDA8', '#000033'],
                         data=figdata)
-    panel.get_figure().savefig('tld_bar.png')
+    save_figure(panel.get_figure(), 'tld_bar.png')
     af.add_existing_file('tld_bar.png', remove=True)
     plt.close()
 
@@ -608,32 +1835,18 @@ def map_oa_noa(af, mapdata):
                         panel_titles=True, cmap=coardmap,
                         legend_kwds={'label': 'Downloads',
                                      'orientation': "horizontal"})
-    panel.savefig('map_oa_noa.png')
-    af.add_existing_file('map_oa_noa.png', remove=True)
-    plt.close()
-
-    panel = map_compare(mapdata, ['Total OA Book Downloads', 'Total Non-OA Book Downloads'],
-                        vmin=1, vmax=10000000,
-                        panel_titles=True, cmap=lilacs,
-                        legend_kwds={'label': 'Downloads',
-                                     'orientation': "horizontal"})
-    panel.savefig('map_oa_noa_lilac.png')
-    af.add_existing_file('map_oa_noa_lilac.png', remove=True)
-    plt.close()
+    save_map_variants(af, panel, 'map_oa_noa')
 
 
-def av_downloads(af, usage, world):
-    oa_download = usage[usage.is_oa == True].groupby(['iso_a3']).sum()['downloads'].to_frame().reset_index().set_index(
-        'iso_a3')
-    noa_download = usage[usage.is_oa == False].groupby(['iso_a3']).sum()[
-        'downloads'].to_frame().reset_index().set_index(
-        'iso_a3')
+def av_downloads(af, cube, world, countries):
+    oa_download = cube_country_downloads(cube, len(countries), is_oa=True)
+    noa_download = cube_country_downloads(cube, len(countries), is_oa=False)
 
-    oa_download_perbook = oa_download.div(usage[usage['is_oa'] == True]['isbn'].nunique())
-    noa_download_perbook = noa_download.div(usage[usage['is_oa'] == False]['isbn'].nunique())
+    oa_download_perbook = oa_download / cube_num_books(cube, is_oa=True)
+    noa_download_perbook = noa_download / cube_num_books(cube, is_oa=False)
 
-    mapdata = world.join(oa_download_perbook)
-    mapdata = mapdata.join(noa_download_perbook, rsuffix='_noa')
+    mapdata = country_join(world, {'downloads': oa_download_perbook,
+                                   'downloads_noa': noa_download_perbook})
 
     figdata = mapdata
     figdata['Average downloads per OA book'] = figdata.downloads.fillna(0)
@@ -646,30 +1859,17 @@ def av_downloads(af, usage, world):
                         legend_kwds={'label': 'Downloads',
                                      'orientation': "horizontal"})
 
-    panel.savefig('av_downloads.png')
-    af.add_existing_file('av_downloads.png', remove=True)
-    plt.close()
-
-    panel = map_compare(mapdata, ['Average downloads per OA book', 'Average downloads per non-OA book'],
-                        figsize=(12, 12),
-                        vmin=1, vmax=mapdata['downloads'].max(),
-                        panel_titles=True, cmap=lilacs,
-                        legend_kwds={'label': 'Downloads',
-                                     'orientation': "horizontal"})
-    panel.savefig('av_downloads_lilac.png')
-    af.add_existing_file('av_downloads_lilac.png', remove=True)
-    plt.close()
+    save_map_variants(af, panel, 'av_downloads')
 
 
-def anonymous_where_no_logged(af, usage, world):
-    country_logged = usage[['is_oa', 'logged', 'iso_a3', 'downloads']]  # logged downloads
-    country_loggeda = country_logged.dropna()  # remove no downloads
-    country_log = country_loggeda.groupby(['is_oa', 'logged', 'iso_a3']).sum()['downloads']  # grouping
-    colog = country_log.to_frame().reset_index()  # reset index
-    testlogged = colog.loc[colog['logged'] == True].groupby(['iso_a3']).sum()['downloads']  # extract logged
-    testanon = colog.loc[colog['logged'] == False].groupby(['iso_a3']).sum()['downloads']  # extract anonymous
-    nologged = testanon[~testanon.index.isin(testlogged.index)]  # extract only countries with logged usage
-    figdata = world.join(nologged)
+def anonymous_where_no_logged(af, cube, world, countries):
+    colog = cube[['is_oa', 'logged', 'iso_a3', 'downloads']].notna().all(axis=1).values  # remove no downloads
+    ids = cube.country_id.values
+    testlogged = country_counts(ids, len(countries), mask=colog & cube_mask(cube, logged=True))  # extract logged
+    testanon = country_sums(ids, cube.downloads.values, len(countries),
+                            mask=colog & cube_mask(cube, logged=False))  # extract anonymous
+    nologged = np.where(testlogged > 0, np.nan, testanon)  # extract only countries with logged usage
+    figdata = country_join(world, {'downloads': nologged})
     figdata['Anonymous downloads from countries having no logged downloads'] = figdata.downloads.fillna(1)
 
     panel = map_compare(figdata, ['Anonymous downloads from countries having no logged downloads'],
@@ -677,29 +1877,13 @@ def anonymous_where_no_logged(af, usage, world):
                         panel_titles=False, cmap=coardmap,
                         legend_kwds={'label': 'Anonymous downloads',
                                      'orientation': "horizontal"})
-    panel.savefig('anon_where_no_logged.png')
-    af.add_existing_file('anon_where_no_logged.png', remove=True)
-    plt.close()
-
-    panel = map_compare(figdata, ['Anonymous downloads from countries having no logged downloads'],
-                        figsize=(12, 6),
-                        panel_titles=False, cmap=lilacs,
-                        legend_kwds={'label': 'Anonymous downloads',
-                                     'orientation': "horizontal"})
-    panel.savefig('anon_where_no_logged_lilac.png')
-    af.add_existing_file('anon_where_no_logged_lilac.png', remove=True)
-    plt.close()
+    save_map_variants(af, panel, 'anon_where_no_logged')
 
 
-def anon_v_logged(af, usage, world):
-    oalogged = usage[(usage.is_oa == True) &
-                     (usage.logged == True)]
-    oaanon = usage[(usage.is_oa == True) &
-                   (usage.logged == False)]
-    geooalogged = oalogged.groupby('iso_a3').sum()['downloads']
-    geooaanon = oaanon.groupby('iso_a3').sum()['downloads']
-    mapdata = world.join(geooalogged)
-    mapdata = mapdata.join(geooaanon, rsuffix='_anon')
+def anon_v_logged(af, cube, world, countries):
+    geooalogged = cube_country_downloads(cube, len(countries), is_oa=True, logged=True)
+    geooaanon = cube_country_downloads(cube, len(countries), is_oa=True, logged=False)
+    mapdata = country_join(world, {'downloads': geooalogged, 'downloads_anon': geooaanon})
 
     mapdata['downloads'] = mapdata.downloads.fillna(1)
     mapdata['downloads_anon'] = mapdata.downloads_anon.fillna(1)
@@ -713,85 +1897,38 @@ def anon_v_logged(af, usage, world):
                         panel_titles=True, cmap=coardmap,
                         legend_kwds={'label': 'Downloads',
                                      'orientation': "horizontal"})
-    panel.savefig('anon_v_logged.png')
-    af.add_existing_file('anon_v_logged.png', remove=True)
-    plt.close()
-
-    panel = map_compare(mapdata, ['Logged access downloads',
-                                  'Anonymous access downloads'],
-                        figsize=(12, 12),
-                        vmin=1, vmax=mapdata['downloads_anon'].max(),
-                        panel_titles=True, cmap=lilacs,
-                        legend_kwds={'label': 'Downloads',
-                                     'orientation': "horizontal"})
-    panel.savefig('anon_v_logged_lilac.png')
-    af.add_existing_file('anon_v_logged_lilac.png', remove=True)
-    plt.close()
+    save_map_variants(af, panel, 'anon_v_logged')
 
 
-def africa_title_effect(af, usage, continents, world):
+def africa_title_effect(af, effects, world):
     panel = regional_effect("AFRICA",
                             ['Increase in downloads of all books with Africa in the title',
                              'Increase in downloads of OA books with Africa in the title',
                              'Increase in downloads of Non-OA books with Africa in the title'],
-                            continents, usage, world, colornorm=colors.Normalize, cmap=coardmap)
+                            effects, world, colornorm=colors.Normalize, cmap=coardmap)
 
-    panel.savefig('africa_title_effect.png')
-    af.add_existing_file('africa_title_effect.png', remove=True)
-    plt.close()
+    save_map_variants(af, panel, 'africa_title_effect')
 
-    panel = regional_effect("AFRICA",
-                            ['Increase in downloads of all books with Africa in the title',
-                             'Increase in downloads of OA books with Africa in the title',
-                             'Increase in downloads of Non-OA books with Africa in the title'],
-                            continents, usage, world, colornorm=colors.Normalize, cmap=lilacs)
-
-    panel.savefig('africa_title_effect_lilac.png')
-    af.add_existing_file('africa_title_effect_lilac.png', remove=True)
-    plt.close()
 
-
-def latam_title_effect(af, usage, continents, world):
+def latam_title_effect(af, effects, world):
     panel = regional_effect("LATIN_AMERICA",
                             ['Increase in downloads of all books with Latin America in the title',
                              'Increase in downloads of OA books with Latin America in the title',
                              'Increase in downloads of Non-OA books with Latin America in the title'],
-                            continents, usage, world, cmap=coardmap)
+                            effects, world, cmap=coardmap)
 
-    panel.savefig('latam_title_effect.png')
-    af.add_existing_file('latam_title_effect.png', remove=True)
-    plt.close()
+    save_map_variants(af, panel, 'latam_title_effect')
 
-    panel = regional_effect("LATIN_AMERICA",
-                            ['Increase in downloads of all books with Latin America in the title',
-                             'Increase in downloads of OA books with Latin America in the title',
-                             'Increase in downloads of Non-OA books with Latin America in the title'],
-                            continents, usage, world, cmap=lilacs)
-
-    panel.savefig('latam_title_effect_lilac.png')
-    af.add_existing_file('latam_title_effect_lilac.png', remove=True)
-    plt.close()
-
-
-def usage_normal_by_pubs(af, usage, world, normal):
-    pubs = normal.set_index('iso_a3')
-    oa_download = usage[usage.is_oa == True].groupby(['iso_a3']).agg(
-        downloads=pd.NamedAgg(column='downloads', aggfunc='sum')
-    )
-    noa_download = usage[usage.is_oa == False].groupby(['iso_a3']).agg(
-        downloads=pd.NamedAgg(column='downloads', aggfunc='sum')
-    )
-    oa_effect = oa_download['downloads'].div(pubs['Publications']).div(usage[usage['is_oa'] == True]['isbn'].nunique())
-    noa_effect = noa_download['downloads'].div(pubs['Publications']).div(
-        usage[usage['is_oa'] == False]['isbn'].nunique())
-    oa_effect = oa_effect.to_frame()
-    noa_effect = noa_effect.to_frame()
 
-    oa_effect.rename(columns={0: 'downloads'}, inplace=True)
-    noa_effect.rename(columns={0: 'downloads'}, inplace=True)
+def usage_normal_by_pubs(af, cube, world, countries, normal):
+    pubs = country_values(country_ids(normal.iso_a3, countries), normal.Publications.values,
+                          len(countries))
+    oa_download = cube_country_downloads(cube, len(countries), is_oa=True)
+    noa_download = cube_country_downloads(cube, len(countries), is_oa=False)
+    oa_effect = oa_download / pubs / cube_num_books(cube, is_oa=True)
+    noa_effect = noa_download / pubs / cube_num_books(cube, is_oa=False)
 
-    mapdata = world.join(oa_effect, on='iso_a3')
-    mapdata = mapdata.join(noa_effect, on='iso_a3', rsuffix='_noa')
+    mapdata = country_join(world, {'downloads': oa_effect, 'downloads_noa': noa_effect})
 
     figdata = mapdata
     figdata['OA book downloads normalized by publication'] = figdata.downloads.fillna(0.0001)
@@ -803,100 +1940,116 @@ def usage_normal_by_pubs(af, usage, world, normal):
                         panel_titles=True, cmap=coardmap,
                         legend_kwds={'label': 'Downloads',
                                      'orientation': "horizontal"})
-    panel.savefig('norm_downloads.png')
-    af.add_existing_file('norm_downloads.png', remove=True)
-    plt.close()
+    save_map_variants(af, panel, 'norm_downloads', variants=MAP_VARIANTS[:1])
 
 
 ##############
 # Case Study #
 ##############
 
-def case_study(isbn, usage, world, af):
-    case_study_metadata(isbn, usage, af)
-    casestudy_advantage_map(isbn, usage, world, af)
-    casestudy_countrytable(isbn, usage, 'KEN', af)
+CaseStudy = namedtuple('CaseStudy', ['isbn', 'name', 'focus_country', 'discipline', 'imprint'])
 
 
-def case_study_book(isbn, df):
-    return df[df.isbn == isbn]
+def report_case_studies(af, usage_index, cube_index, gini, world):
+    # Run the case study code on Digital Kenya, further titles can be added to
+    # the list and are written with an ISBN suffix
+    studies = [
+        CaseStudy('978-1-137-57878-5', 'Digital Kenya', 'KEN', 'Economics', 'Palgrave Macmillan'),
+    ]
+    case_studies(studies, usage_index, cube_index, gini, world, af)
 
 
-def case_study_group(cluster, category, year, df):
-    return df[(df.cluster == cluster) &
-              (df.category == category) &
-              (df.year == year)]
+def case_studies(studies, usage_index, cube_index, gini, world, af):
+    """Metadata, advantage map and country table for a batch of titles
 
+    The corpus-wide baselines are computed once (see case_study_context) so
+    the work per title only touches that title's rows. The first study keeps
+    the file names the report template reads, the others are suffixed with
+    their ISBN."""
+    context = case_study_context([study.isbn for study in studies],
+                                 usage_index, cube_index, gini, world)
+    for i, study in enumerate(studies):
+        suffix = '' if i == 0 else f'_{study.isbn}'
+        case_study_metadata(study, context, af, suffix)
+        casestudy_advantage_map(study.isbn, context, af, suffix)
+        casestudy_countrytable(study, context, af, suffix)
 
-def case_study_metadata(isbn, usage, af):
-    book = case_study_book(isbn, usage)
-    cluster = book.cluster.values[0]
-    category = book.category.values[0]
-    year = book.year.values[0]
-    group = case_study_group(cluster, category, year, usage)
 
-    nonoa = usage[usage.is_oa == False].groupby(['isbn']).agg(
-        num_countries=pd.NamedAgg(column='country', aggfunc='nunique'),
-        num_downloads=pd.NamedAgg(column='downloads', aggfunc='sum')
-    )
-    av_nonoa_countries = nonoa.num_countries.mean()
+CaseStudyContext = namedtuple('CaseStudyContext', [
+    'books', 'cube_books', 'nonoa_countries', 'group_means', 'countries_all',
+    'mapall', 'num_books', 'gini', 'africa'])
+
+
+def case_study_context(isbns, usage_index, cube_index, gini, world):
+    """Baselines shared by every case study, plus the rows of each title
 
-    nonoa_group = group[group.is_oa == False].groupby(['isbn']).agg(
+    Holds the non-OA country average, the per-group (cluster, category, year)
+    non-OA means, the global country ranking, the per-country cube totals and
+    the Gini table, and the usage and cube rows of `isbns` sliced from the
+    isbn indexes."""
+    usage, cube = usage_index.frame, cube_index.frame
+    books = {isbn: book_rows(usage_index, isbn) for isbn in isbns}
+    cube_books = {isbn: book_rows(cube_index, isbn) for isbn in isbns}
+
+    nonoa = usage[usage.is_oa == False].groupby(['isbn'], observed=True).agg(
         num_countries=pd.NamedAgg(column='country', aggfunc='nunique'),
         num_downloads=pd.NamedAgg(column='downloads', aggfunc='sum'),
-        num_months=pd.NamedAgg(column='month', aggfunc='nunique')
+        num_months=pd.NamedAgg(column='month', aggfunc='nunique'),
+        cluster=pd.NamedAgg(column='cluster', aggfunc='first'),
+        category=pd.NamedAgg(column='category', aggfunc='first'),
+        year=pd.NamedAgg(column='year', aggfunc='first')
     )
-    av_group_nonoa_countries = nonoa_group.num_countries.mean()
-    av_groupnonoa_downloads = nonoa_group.num_downloads.mean()
-    av_groupnonoa_monthlydownloads = (nonoa_group.num_downloads / nonoa_group.num_months).mean()
+    nonoa['monthly_downloads'] = nonoa.num_downloads / nonoa.num_months
+    group_means = nonoa.groupby(['cluster', 'category', 'year'], observed=True)[
+        ['num_countries', 'num_downloads', 'monthly_downloads']].mean()
 
-    countries = usage.groupby(['isbn', 'Open Access', 'iso_a3']).sum()['downloads']
-    countries = countries.unstack('iso_a3', fill_value=0)
-    countries = countries.sort_index(level=0)
-    gini = usage[['isbn', 'short_cluster', 'category', 'Open Access']]
-    gini = gini.groupby('isbn').first()
-    gini.reset_index(inplace=True)
-    gini.sort_values('isbn')
-    cort = countries.reset_index().sort_values('isbn')
-    del cort['Open Access']
-    cort = cort.set_index(cort.isbn)
-    del cort['isbn']
-    cort = cort.values.astype(int)
-    gini['Gini Coefficient'] = np.array([ineq(x) for x in cort])
-    book_gini = gini.loc[gini.isbn == isbn, 'Gini Coefficient'].values[0]
+    countries_all = usage.groupby('iso_a3', observed=True).agg(
+        country=pd.NamedAgg(column='country', aggfunc='first'),
+        downloads=pd.NamedAgg(column='downloads', aggfunc='sum')
+    )
+    countries_all['rank'] = countries_all.downloads.rank(ascending=False)
+    countries_all = countries_all.sort_values('downloads', ascending=False)
+
+    return CaseStudyContext(books, cube_books, nonoa.num_countries.mean(), group_means,
+                            countries_all, cube_downloads(cube).to_frame(),
+                            cube_num_books(cube), gini, world.query('continent == "Africa"'))
+
+
+def case_study_metadata(study, context, af, suffix=''):
+    book = context.books[study.isbn]
+    cluster = book.cluster.values[0]
+    category = book.category.values[0]
+    year = book.year.values[0]
+    group = context.group_means.loc[(cluster, category, year)]
+
+    book_gini = context.gini.loc[study.isbn, 'Gini Coefficient']
 
     case_study_metadata = {
         'Publication Year': int(year),
-        'ISBN': isbn,
-        'Discipline': 'Economics',
+        'ISBN': study.isbn,
+        'Discipline': study.discipline,
         'Product category': category,
         'Cluster': cluster,
-        'Imprint': 'Palgrave Macmillan',
+        'Imprint': study.imprint,
         'Total number of countries': int(book.country.nunique()),
-        'Average number of countries for non-OA titles': int(av_nonoa_countries),
-        'Average number of countries for non-OA titles in the same group': int(av_group_nonoa_countries),
+        'Average number of countries for non-OA titles': int(context.nonoa_countries),
+        'Average number of countries for non-OA titles in the same group': int(group.num_countries),
         'Country Gini coefficient': np.round(book_gini, decimals=3),
         'Total chapter downloads': int(book.downloads.sum()),
-        'Chapter downloads average for non-OA titles in the same category': int(av_groupnonoa_downloads),
+        'Chapter downloads average for non-OA titles in the same category': int(group.num_downloads),
         'Monthly mean average chapter downloads': int(book.downloads.sum() / book.month.nunique()),
         'Monthly mean average chapter download for non-OA titles in the same category':
-            int(av_groupnonoa_monthlydownloads)
+            int(group.monthly_downloads)
     }
 
-    for f in af.generate_file('case_study_metadata.json'):
+    for f in af.generate_file(f'case_study_metadata{suffix}.json'):
         json.dump(case_study_metadata, f)
 
 
-def casestudy_advantage_map(isbn, usage, world, af):
-    mapall = usage.groupby('iso_a3').sum()['downloads'].to_frame().reset_index()
-    mapall.set_index('iso_a3', inplace=True)
-
-    df1 = usage[usage.isbn == isbn].groupby(['iso_a3', ]).sum()['downloads'].to_frame()
-    df1['times'] = df1.div(mapall).multiply(usage['isbn'].nunique())
-    mapdata = world.query('continent == "Africa"')
-
-    oa_effect = df1.div(mapall).multiply(usage['isbn'].nunique())
-    mapdata = mapdata.join(oa_effect)
+def casestudy_advantage_map(isbn, context, af, suffix=''):
+    df1 = cube_downloads(context.cube_books[isbn]).to_frame()
+    oa_effect = df1.div(context.mapall).multiply(context.num_books)
+    mapdata = context.africa.join(oa_effect)
 
     figdata = mapdata
     figdata['Book downloads normalized by publication'] = figdata.downloads.fillna(1)
@@ -906,71 +2059,154 @@ def casestudy_advantage_map(isbn, usage, world, af):
                         legend_kwds={'label': 'Increase in usage',
                                      'orientation': "horizontal"})
 
-    panel.savefig('case_study_advantage_map.png')
-    af.add_existing_file('case_study_advantage_map.png', remove=True)
-    plt.close()
-
-    panel = map_compare(figdata, ['Book downloads normalized by publication'],
-                        xlim=(-20, 55), ylim=(-35, 38),
-                        panel_titles=False, cmap=lilacs,
-                        legend_kwds={'label': 'Increase in usage',
-                                     'orientation': "horizontal"})
-
-    panel.savefig('case_study_advantage_map_lilac.png')
-    af.add_existing_file('case_study_advantage_map_lilac.png', remove=True)
-    plt.close()
+    save_map_variants(af, panel, f'case_study_advantage_map{suffix}')
 
 
-def casestudy_countrytable(isbn, usage, focus_country, af):
-    countries_all = usage.groupby('iso_a3').agg(
-        country=pd.NamedAgg(column='country', aggfunc='first'),
-        downloads=pd.NamedAgg(column='downloads', aggfunc='sum')
-    )
-    countries_all['rank'] = countries_all.downloads.rank(ascending=False)
-    countries_all = countries_all.sort_values('downloads', ascending=False)
+def casestudy_countrytable(study, context, af, suffix=''):
+    countries_all = context.countries_all
 
-    book = case_study_book(isbn, usage)
-    book_logged = book[book.logged == True].groupby('iso_a3').agg(
+    book = context.books[study.isbn]
+    book_logged = book[book.logged == True].groupby('iso_a3', observed=True).agg(
         country=pd.NamedAgg(column='country', aggfunc='first'),
         downloads=pd.NamedAgg(column='downloads', aggfunc='sum')
     )
     book_logged['rank'] = book_logged.downloads.rank()
     book_logged = book_logged.sort_values('downloads', ascending=False)
 
-    book_anon = book[book.logged == False].groupby('iso_a3').agg(
+    book_anon = book[book.logged == False].groupby('iso_a3', observed=True).agg(
         country=pd.NamedAgg(column='country', aggfunc='first'),
         downloads=pd.NamedAgg(column='downloads', aggfunc='sum')
     )
     book_anon = book_anon.sort_values('downloads', ascending=False)
 
+    logged_column = f'Logged ({study.name})'
+    anon_column = f'Anonymous ({study.name})'
     rows = []
     for i in range(10):
         rows.append({
             'Overall (all books)': countries_all.country.values[i],
-            'Logged (Digital Kenya)': book_logged.country.values[i],
-            'Anonymous (Digital Kenya)': book_anon.country.values[i]
+            logged_column: book_logged.country.values[i],
+            anon_column: book_anon.country.values[i]
         })
 
+    focus_country = study.focus_country
     if focus_country:
         rank = countries_all.loc[focus_country, 'rank']
         rows.append({
             'Overall (all books)': f'{focus_country} ({rank})',
-            'Logged (Digital Kenya)': '',
-            'Anonymous (Digital Kenya)': ''
+            logged_column: '',
+            anon_column: ''
         })
 
     case_study_countrytable = {
         'title': '',
         'columns': [{'name': 'Overall (all books)'},
-                    {'name': 'Logged (Digital Kenya)'},
-                    {'name': 'Anonymous (Digital Kenya)'}],
+                    {'name': logged_column},
+                    {'name': anon_column}],
         'rows': rows
     }
 
-    for f in af.generate_file('case_study_countrytable.json'):
+    for f in af.generate_file(f'case_study_countrytable{suffix}.json'):
         json.dump(case_study_countrytable, f)
 
 
+##################################
+# Bootstrap Confidence Intervals #
+##################################
+
+CI_COLUMNS = ['n', 'mean', 'ci_low', 'ci_high']
+
+
+def bootstrap_ci(df, value, by,
+                 n_boot=None, level=None, seed=None,
+                 chunksize=None, workers=None,
+                 cache_dir=BOOTSTRAP_CACHE_DIR):
+    """Mean of `value` per `by` group with a percentile bootstrap interval
+
+    Stands in for seaborn's per-group bootstrap: the resamples of every group
+    are drawn together (see bootstrap_means), with a fixed seed so figures and
+    the exported tables are reproducible. Returns the `by` columns with n,
+    mean, ci_low and ci_high; groups of a single value have no interval. The
+    result is kept in cache_dir under a key of the input data and settings,
+    cache_dir=None always computes it."""
+    n_boot = n_boot or BOOTSTRAP_RESAMPLES
+    level = level or BOOTSTRAP_LEVEL
+    seed = BOOTSTRAP_SEED if seed is None else seed
+
+    data = df.loc[df[value].notna(), by + [value]].dropna(subset=by)
+    key = hashlib.sha256(' '.join([frame_digest(data), value, repr(by),
+                                   str(n_boot), str(level), str(seed)]).encode()).hexdigest()
+    cached_filepath = os.path.join(cache_dir, f'{key}.pkl') if cache_dir else None
+    if cached_filepath and os.path.exists(cached_filepath):
+        return pd.read_pickle(cached_filepath)
+
+    with profile_stage(f'bootstrap {value}', rows=len(data)):
+        data = data.sort_values(by, kind='stable')
+        groups = data.groupby(by, observed=True, sort=False)[value]
+        cis = groups.agg(n='size', mean='mean').reset_index()
+        sizes = cis.n.values
+        means = bootstrap_means(data[value].values.astype(float), sizes, n_boot, seed,
+                                chunksize=chunksize, workers=workers)
+        tail = (100 - level) / 2
+        cis['ci_low'], cis['ci_high'] = np.percentile(means, [tail, 100 - tail], axis=0)
+        cis.loc[sizes < 2, ['ci_low', 'ci_high']] = np.nan
+
+    if cached_filepath:
+        os.makedirs(cache_dir, exist_ok=True)
+        cis.to_pickle(cached_filepath)
+    return cis
+
+
+def bootstrap_means(values, sizes, n_boot, seed, chunksize=None, workers=None):
+    """Bootstrap means of consecutive groups of `values`, n_boot x len(sizes)
+
+    Each chunk of resamples is one index matrix, a row per resample with every
+    group drawing from its own rows, reduced to group means with reduceat.
+    The chunks have their own seeds spawned from `seed` and at most
+    `chunksize` entries, so the result depends only on the seed and chunksize,
+    not on the number of worker threads."""
+    chunksize = chunksize or BOOTSTRAP_CHUNKSIZE
+    workers = workers or BOOTSTRAP_WORKERS
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.intp)
+    group = np.repeat(np.arange(len(sizes)), sizes)
+
+    per_chunk = max(1, chunksize // max(len(values), 1))
+    counts = [min(per_chunk, n_boot - start) for start in range(0, n_boot, per_chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(counts))
+    row_starts, row_sizes = starts[group], sizes[group]
+    resample = partial(_bootstrap_chunk, values, sizes, row_starts, row_sizes,
+                       row_starts + row_sizes - 1, starts)
+    if workers > 1 and len(counts) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            chunks = list(pool.map(resample, counts, seeds))
+    else:
+        chunks = [resample(count, chunk_seed) for count, chunk_seed in zip(counts, seeds)]
+    return np.vstack(chunks)
+
+
+def _bootstrap_chunk(values, sizes, row_starts, row_sizes, row_lasts, starts, count, seed):
+    # Uniform draws scaled in place to row offsets within each group, the
+    # integer part of start + u * size is the resampled row. For large starts
+    # the float sum can round up to start + size, hence the clamp to the
+    # group's last row
+    index = np.random.default_rng(seed).random((count, len(values)))
+    index *= row_sizes
+    index += row_starts
+    index = index.astype(np.intp)
+    np.minimum(index, row_lasts, out=index)
+    return np.add.reduceat(values[index], starts, axis=1) / sizes
+
+
+def export_cis(af, filename, panels):
+    """Write the bootstrap tables of a figure's panels as one CSV, a panel
+    column naming the panel of each row"""
+    table = pd.concat([cis.assign(panel=panel) for panel, cis in panels.items()],
+                      ignore_index=True)
+    table = table[['panel'] + [c for c in table if c not in ['panel'] + CI_COLUMNS] + CI_COLUMNS]
+    for f in af.generate_file(filename):
+        table.to_csv(f, index=False)
+
+
 #################
 # Graph Layouts #
 #################
@@ -1027,33 +2263,124 @@ def grid_panel(chart_type,
     return figpanel
 
 
+def ci_errorbars(ax, cis, x, order,
+                 hue='Open Access', hue_order=[True, False],
+                 width=0.8):
+    """Error bars of a bootstrap_ci table on a barplot drawn with ci=None, at
+    seaborn's (dodged) bar positions"""
+    levels = hue_order if hue else [None]
+    for i, level in enumerate(levels):
+        rows = cis if level is None else cis[cis[hue] == level]
+        rows = rows.set_index(x).reindex(order)
+        positions = np.arange(len(order)) + (i - (len(levels) - 1) / 2) * width / len(levels)
+        ax.vlines(positions, rows.ci_low.values, rows.ci_high.values,
+                  color='.26', linewidth=1.5 * plt.rcParams['lines.linewidth'])
+
+
+def ci_bands(ax, cis, x,
+             hue='Open Access', hue_order=[True, False],
+             palette=['#00DDA8', '#000033']):
+    """Confidence bands of a bootstrap_ci table on a lineplot drawn with ci=None"""
+    for level, color in zip(hue_order, palette):
+        rows = cis[cis[hue] == level].sort_values(x)
+        ax.fill_between(rows[x].values, rows.ci_low.values, rows.ci_high.values,
+                        color=color, alpha=0.2, linewidth=0)
+
+
+def facet_cis(figpanel, cis, draw, row='category', col='short_cluster', **kwargs):
+    """Draw the rows of a bootstrap_ci table on each facet of a grid_panel
+    with `draw` (ci_errorbars or ci_bands)"""
+    for (row_name, col_name), ax in figpanel.axes_dict.items():
+        draw(ax, cis[(cis[row] == row_name) & (cis[col] == col_name)], **kwargs)
+
+
+def panel_image(panel, dpi=300, pad_inches=0.1):
+    """RGBA pixels of a figure (or FacetGrid) cropped to its tight bounding box
+
+    The figure is drawn once on an Agg canvas and the crop is a view of the
+    canvas buffer, so a panel can be composed and encoded without writing and
+    decoding an intermediate PNG. Matches savefig(bbox_inches='tight') up to
+    sub-pixel placement."""
+    fig = panel if isinstance(panel, plt.Figure) else panel.figure
+    with profile_stage('panel_image'):
+        fig.set_dpi(dpi)
+        canvas = FigureCanvasAgg(fig)
+        canvas.draw()
+        pixels = np.asarray(canvas.buffer_rgba())
+        bbox = fig.get_tightbbox(canvas.get_renderer()).padded(pad_inches)
+
+        height, width = pixels.shape[:2]
+        x0, x1 = int(round(bbox.x0 * dpi)), int(round(bbox.x0 * dpi)) + int(bbox.width * dpi)
+        y0 = int(round(height - bbox.y1 * dpi))
+        y1 = y0 + int(bbox.height * dpi)
+        if x0 >= 0 and y0 >= 0 and x1 <= width and y1 <= height:
+            return pixels[y0:y1, x0:x1]
+
+        # Artists outside the figure, pad with the (white) background
+        image = np.full((y1 - y0, x1 - x0, 4), 255, dtype=np.uint8)
+        src = pixels[max(y0, 0):min(y1, height), max(x0, 0):min(x1, width)]
+        image[max(-y0, 0):max(-y0, 0) + src.shape[0], max(-x0, 0):max(-x0, 0) + src.shape[1]] = src
+        return image
+
+
+def save_png(pixels, filename, compress_level=None, dpi=300):
+    """Encode an RGB(A) array as PNG, compress_level 0 (fast) to 9 (small)"""
+    if compress_level is None:
+        compress_level = PNG_COMPRESS_LEVEL
+    with profile_stage(f'save_png {filename}'):
+        Image.fromarray(pixels).save(filename, compress_level=compress_level, dpi=(dpi, dpi))
+
+
 def combine_panels(af,
                    panela,
                    panelb,
                    new_image_name: str,
-                   y_pad: int = 10):
-    a_filepath = af.path_to_cached_file(
-        panela)
-    b_filepath = af.path_to_cached_file(
-        panelb)
-
-    a = Image.open(a_filepath)
-    b = Image.open(b_filepath)
-
-    total_width = b.size[0]
-    total_height = a.size[1] + b.size[1]
-
-    new_image = Image.new('RGB', (total_width, total_height), (255, 255, 255))
-    new_image.paste(a, (0, 0))
-    new_image.paste(b, (0, a.size[1] + y_pad))
-    new_image.save(new_image_name)
-    af.add_existing_file(new_image_name, remove=True)
+                   y_pad: int = 10,
+                   panel_names=None,
+                   compress_level=None,
+                   workers=None):
+    """Stack panel a above panel b and save the composite as new_image_name
+
+    The panels are pixel arrays from panel_image; filenames of saved panels
+    are also accepted and decoded from the af cache. The composite is built
+    in memory and, with panel_names, the panels are saved as well. The PNGs
+    are encoded with compress_level, on `workers` threads (PNG_ENCODE_WORKERS
+    by default) since the encoder releases the GIL."""
+    with profile_stage(f'combine_panels {new_image_name}'):
+        if isinstance(panela, str):
+            panela = np.asarray(Image.open(af.path_to_cached_file(panela)).convert('RGBA'))
+        if isinstance(panelb, str):
+            panelb = np.asarray(Image.open(af.path_to_cached_file(panelb)).convert('RGBA'))
+
+        a_height, a_width = panela.shape[:2]
+        total_width = panelb.shape[1]
+        total_height = a_height + panelb.shape[0]
+
+        new_image = np.full((total_height, total_width, 3), 255, dtype=np.uint8)
+        new_image[:a_height, :min(a_width, total_width)] = panela[:, :total_width, :3]
+        b_top = a_height + y_pad
+        new_image[b_top:] = panelb[:total_height - b_top, :, :3]
+
+        images = [(new_image, new_image_name)]
+        if panel_names:
+            images = list(zip([panela, panelb], panel_names)) + images
+        workers = workers or PNG_ENCODE_WORKERS
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(lambda image: save_png(*image, compress_level), images))
+        else:
+            for pixels, filename in images:
+                save_png(pixels, filename, compress_level)
+
+    for _, filename in images:
+        af.add_existing_file(filename, remove=True)
 
 
 ###############
 # Map Layouts #
 ###############
 
+@profile_stage('map_compare')
 def map_compare(df, columns, title=None,
                 vmin=None, vmax=None,
                 cmap=None, colornorm=colors.LogNorm,  # Blues
@@ -1063,7 +2390,8 @@ def map_compare(df, columns, title=None,
                 fig_kwargs={},
                 gs_kwargs={'hspace': 0.2},
                 legend_label=None,
-                legend_kwds={'orientation': "horizontal"}):
+                legend_kwds={'orientation': "horizontal"},
+                simplify=None):
     if not vmin:
         vmin = min([min(df[col]) for col in columns])
     if not vmax:
@@ -1096,13 +2424,22 @@ def map_compare(df, columns, title=None,
             cmp = cmap[i]
         if legend_label:
             legend_kwds['label'] = legend_label
-        panel = df.plot(column=col, ax=ax,
-                        norm=colornorm(vmin, vmax),
-                        cmap=cmp, cax=cax,
-                        linewidth=0.2, edgecolor="black",
-                        # vmin=vmin, vmax=vmax,
-                        legend=True,
-                        legend_kwds=legend_kwds)
+        cached = world_paths(simplify) if 'geom_id' in df else None
+        if cached:
+            # Draw from the cached world paths instead of re-tessellating
+            plot_world_paths(df, col, ax, cached,
+                             norm=colornorm(vmin, vmax),
+                             cmap=cmp, cax=cax,
+                             linewidth=0.2, edgecolor="black",
+                             legend_kwds=legend_kwds)
+        else:
+            panel = df.plot(column=col, ax=ax,
+                            norm=colornorm(vmin, vmax),
+                            cmap=cmp, cax=cax,
+                            linewidth=0.2, edgecolor="black",
+                            # vmin=vmin, vmax=vmax,
+                            legend=True,
+                            legend_kwds=legend_kwds)
         # ax.set_title(title, fontsize=25)
         map_axes.append(ax)
         st = fig.suptitle(title, fontsize="x-large")
@@ -1112,39 +2449,68 @@ def map_compare(df, columns, title=None,
     return ax.figure
 
 
-def regional_effect(region, maptitles, continents, usage, world, colornorm=None, cmap=None):
-    dfregion = continents.loc[continents[region] == True]
-    rtitles = dfregion.reset_index()['ISBN13']
-    mapall = usage.groupby('iso_a3').sum()['downloads'].to_frame().reset_index()
-    mapall.set_index('iso_a3', inplace=True)
+def plot_world_paths(df, column, ax, cached, norm, cmap, cax,
+                     linewidth, edgecolor, legend_kwds):
+    """Choropleth of `column` drawn from the cached world paths
+
+    Equivalent to GeoDataFrame.plot(column, legend=True) for the world layer:
+    rows with missing values are skipped and the axes aspect is corrected for
+    the latitude of the plotted geometries."""
+    paths, bounds = cached
+    values = df[column].values
+    geom_ids = df['geom_id'].values[~pd.isna(values)]
+    values = values[~pd.isna(values)].astype(float)
+
+    collection = PatchCollection([PathPatch(paths[i]) for i in geom_ids],
+                                 cmap=cmap, norm=norm,
+                                 linewidth=linewidth, edgecolor=edgecolor)
+    collection.set_array(values)
+    ax.add_collection(collection, autolim=True)
+
+    plotted = bounds[df['geom_id'].values]
+    y_coord = np.mean([np.nanmin(plotted[:, 1]), np.nanmax(plotted[:, 3])])
+    ax.set_aspect(1 / np.cos(y_coord * np.pi / 180))
 
-    # Regional OA titles in the set
-    roatitles = dfregion[dfregion['isOA'] == 'yes'].reset_index()['ISBN13']
+    mappable = cm.ScalarMappable(norm=norm, cmap=cmap)
+    mappable.set_array(np.array([]))
+    ax.figure.colorbar(mappable, ax=ax, cax=cax, **legend_kwds)
+    return ax
 
-    # Regional Non-OA titles in the set
-    rnoatitles = dfregion[dfregion['isOA'] == 'non'].reset_index()['ISBN13']
 
-    # Downloads of OA and non-OA titles related to the region
-    rDownload = usage[usage['isbn'].isin(rtitles.values)].groupby(['iso_a3']).sum()[
-        'downloads'].to_frame().reset_index()
-    roaDownload = usage[usage['isbn'].isin(roatitles.values)].groupby(['iso_a3']).sum()[
-        'downloads'].to_frame().reset_index()
-    rnoaDownload = usage[usage['isbn'].isin(rnoatitles.values)].groupby(['iso_a3']).sum()[
-        'downloads'].to_frame().reset_index()
+def save_figure(fig, filename, **kwargs):
+    """fig.savefig, recorded as a stage of the run profile"""
+    with profile_stage(f'savefig {filename}'):
+        fig.savefig(filename, **kwargs)
 
-    # Number of OA and non-OA title(s) in the set
-    rTitleCount = rtitles.nunique()
-    roaTitleCount = roatitles.nunique()
-    rnoaTitleCount = rnoatitles.nunique()
 
-    # Regional Effect (Times a book is more downloaded than a book on the whole corpus)
-    r_effect = rDownload.set_index('iso_a3').div(rTitleCount).div(mapall).multiply(usage['isbn'].nunique())
-    roa_effect = roaDownload.set_index('iso_a3').div(roaTitleCount).div(mapall).multiply(usage['isbn'].nunique())
-    rnoa_effect = rnoaDownload.set_index('iso_a3').div(rnoaTitleCount).div(mapall).multiply(usage['isbn'].nunique())
+def recolor_map(fig, cmap):
+    """Swap the colormap of every map panel and colorbar of a map_compare figure
 
-    mapdata = world.join(r_effect)
-    mapdata = mapdata.join(roa_effect, rsuffix='_oa')
-    mapdata = mapdata.join(rnoa_effect, rsuffix='_noa')
+    The polygon collections keep their data and norm, so only the face colours
+    are recomputed at the next draw."""
+    for ax in fig.axes:
+        for collection in ax.collections:
+            if collection.get_array() is not None:
+                collection.set_cmap(cmap)
+
+
+def save_map_variants(af, fig, name, variants=MAP_VARIANTS):
+    """Save one map figure in every palette of `variants`
+
+    The geometry and layout are built once by map_compare and only recoloured
+    between saves, instead of plotting the map again for each palette."""
+    for template, cmap in variants:
+        filename = template.format(name)
+        recolor_map(fig, cmap)
+        save_figure(fig, filename)
+        af.add_existing_file(filename, remove=True)
+    plt.close(fig)
+
+
+def regional_effect(region, maptitles, effects, world, colornorm=None, cmap=None):
+    # Regional Effect (Times a book is more downloaded than a book on the
+    # whole corpus) of all, OA and non-OA titles, see regional_effects
+    mapdata = country_join(world, effects[region])
 
     mapdata['downloads'] = mapdata.downloads.fillna(1)
     mapdata['downloads_oa'] = mapdata.downloads_oa.fillna(1)
@@ -1197,3 +2563,365 @@ def rgb_to_dec(value):
     value: list (length 3) of RGB values
     Returns: list (length 3) of decimal values'''
     return [v / 256 for v in value]
+
+
+####################
+# Figure Rendering #
+####################
+
+# Data derived from the cached tables: (output names, function, input names).
+# Each is computed on first use by FigureData.
+DATA_NODES = [
+    (['countries', 'world'], country_dimension, ['usage_cube']),
+    (['usage'], process_usage_data, ['usage_table']),
+    (['usage_cube'], build_usage_cube, ['usage_table']),
+    (['cube'], usage_cube, ['usage_cube', 'countries']),
+    (['mapdata'], process_mapdata, ['cube', 'world', 'countries']),
+    (['gini'], book_distribution, ['usage', 'cube']),
+    (['usage_index'], isbn_index, ['usage']),
+    (['cube_index'], isbn_index, ['cube']),
+    (['regional_effects'], regional_effects, ['continents', 'cube', 'countries']),
+]
+
+# Digests of what a DATA_NODES function reads besides its inputs, e.g. the
+# world layer file, added to the digest of its outputs
+NODE_SOURCES = {
+    country_dimension: world_digest,
+}
+
+# Figure, map and table jobs rendered by plot_figures, each with the names of
+# the data it reads. The jobs are independent of each other.
+FIGURE_JOBS = [
+    (tld_bar, ['tld', 'cube']),
+    (in_text_data, ['usage', 'cites', 'countries', 'tld']),
+    (figure_comparisons, ['usage', 'cites', 'webo']),
+    (figure_downloads_by_time, ['usage']),
+    (figure_gini, ['gini']),
+    (scatter_chapters, ['usage', 'chapters']),
+    (tld_table, ['tld']),
+    (map_oa_noa, ['mapdata']),
+    (av_downloads, ['cube', 'world', 'countries']),
+    (anonymous_where_no_logged, ['cube', 'world', 'countries']),
+    (anon_v_logged, ['cube', 'world', 'countries']),
+    (africa_title_effect, ['regional_effects', 'world']),
+    (latam_title_effect, ['regional_effects', 'world']),
+    (usage_normal_by_pubs, ['cube', 'world', 'countries', 'normal']),
+    (report_case_studies, ['usage_index', 'cube_index', 'gini', 'world']),
+]
+
+# Jobs and data handed to forked render workers
+_RENDER_JOBS = []
+_RENDER_DATA = {}
+_RENDER_FORKED = None  # (names, number of loads) of the data when a render worker forked
+
+
+class FigureData:
+    """Cached tables plus the data derived from them in DATA_NODES
+
+    Tables are given loaded or as loaders, (output names, function, key)
+    like DATA_NODES, which are called the first time one of their tables is
+    looked up; derived data is computed the first time it is looked up too.
+    A table its loader returns as None (e.g. a usage cube the cache does not
+    hold) is derived by the DATA_NODES entry of the same name instead.
+    release_unneeded drops what the remaining figures will not read, and
+    report_loads prints the cost of the loads. digest(name) is a content hash
+    for a loaded table, the loader's key for a lazy one and, for derived data,
+    a hash of the producing function's code and its inputs' digests, so a
+    figure's inputs can be keyed without loading or computing them. Files a
+    node reads itself are covered by its NODE_SOURCES digest."""
+
+    def __init__(self, tables=None, loaders=()):
+        self.values = dict(tables or {})
+        self.digests = {}
+        self.nodes = {name: (outputs, fn, inputs)
+                      for outputs, fn, inputs in DATA_NODES for name in outputs}
+        self.loaders = {name: (outputs, load, key)
+                        for outputs, load, key in loaders for name in outputs}
+        self.loads = []
+
+    def __getitem__(self, name):
+        if name not in self.values and name in self.loaders:
+            outputs, load, _ = self.loaders[name]
+            start = time.perf_counter()
+            result = load()
+            self.loads.append((outputs, time.perf_counter() - start, peak_rss_mb()))
+            for output, value in zip(outputs, result if len(outputs) > 1 else [result]):
+                if value is not None or output not in self.nodes:
+                    self.values.setdefault(output, value)
+        if name not in self.values:
+            outputs, fn, inputs = self.nodes[name]
+            args = [self[i] for i in inputs]
+            with profile_stage(fn.__name__) as stage:
+                result = fn(*args)
+                first = result[0] if len(outputs) > 1 else result
+                stage['rows'] = len(first) if isinstance(first, pd.DataFrame) else None
+            self.values.update(zip(outputs, result if len(outputs) > 1 else [result]))
+        return self.values[name]
+
+    def digest(self, name):
+        if name not in self.digests:
+            # A table with a loader and a node may come from either
+            parts = []
+            if name in self.loaders:
+                parts += [name, self.loaders[name][2]]
+            if name in self.nodes:
+                _, fn, inputs = self.nodes[name]
+                parts += [source_digest(fn)] + [self.digest(i) for i in inputs]
+                if fn in NODE_SOURCES:
+                    parts.append(NODE_SOURCES[fn]())
+            if parts:
+                self.digests[name] = hashlib.sha256(' '.join(parts).encode()).hexdigest()
+            else:
+                self.digests[name] = frame_digest(self.values[name])
+        return self.digests[name]
+
+    def needed(self, jobs):
+        """Names the jobs read, plus the inputs of the derived data among them
+        that is not computed yet"""
+        needed = set()
+        stack = [name for _, inputs in jobs for name in inputs]
+        while stack:
+            name = stack.pop()
+            if name in needed:
+                continue
+            needed.add(name)
+            if name not in self.values and name in self.nodes:
+                stack.extend(self.nodes[name][2])
+        return needed
+
+    def derive_shared(self, jobs):
+        """Load or derive the data that more than one of `jobs` reads
+
+        Cached tables are looked up first, since one that is loaded (e.g. the
+        usage cube) can make the inputs it would be derived from unneeded."""
+        while True:
+            counts = Counter(name for job in jobs for name in self.needed([job]))
+            shared = [name for name, count in counts.items() if count > 1 and name not in self.values]
+            if not shared:
+                return
+            self[min(shared, key=lambda name: (name not in self.loaders, name))]
+
+    def release_unneeded(self, jobs):
+        """Drop the tables and derived data that none of `jobs` reads any more"""
+        needed = self.needed(jobs)
+        released = sorted(name for name in self.values if name not in needed)
+        for name in released:
+            del self.values[name]
+        if released:
+            print(f'Released {", ".join(released)}, peak RSS {peak_rss_mb() or 0:,.0f} MB')
+        return released
+
+    def report_loads(self):
+        """Print the time of each table load and the tables never loaded"""
+        loaded = {name for outputs, _, _ in self.loads for name in outputs}
+        for outputs, seconds, peak_mb in self.loads:
+            print(f'Loaded {", ".join(outputs)} on first use in {seconds:.2f}s, '
+                  f'peak RSS {peak_mb or 0:,.0f} MB')
+        skipped = sorted(set(self.loaders) - loaded)
+        total = sum(seconds for _, seconds, _ in self.loads)
+        print(f'Loaded {len(loaded)} of {len(self.loaders)} tables in {total:.2f}s'
+              + (f', not needed: {", ".join(skipped)}' if skipped else ''))
+
+
+def frame_digest(df):
+    """Content hash of a data frame (or None) including its columns and dtypes"""
+    if df is None:
+        return 'none'
+    digest = hashlib.sha256(repr([(c, str(t)) for c, t in df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def source_digest(fn):
+    """Hash of a function's source and of every function of this module it
+    calls, directly or through other functions of this module, together with
+    the values of the module globals (colormaps, settings, ...) they read"""
+    module = globals()
+    module_functions = {name: obj for name, obj in module.items()
+                        if inspect.isfunction(obj) and obj.__module__ == __name__}
+    seen = {}
+    constants = set()
+    stack = [fn]
+    while stack:
+        f = inspect.unwrap(stack.pop())  # e.g. map_compare under profile_stage
+        if f.__name__ in seen:
+            continue
+        try:
+            seen[f.__name__] = inspect.getsource(f)
+        except OSError:  # no source file, fall back to the bytecode
+            seen[f.__name__] = f.__code__.co_code.hex() + repr(f.__code__.co_consts)
+        # Defaults bind module globals (e.g. variants=MAP_VARIANTS) at definition
+        seen[f.__name__] += _global_repr([f.__defaults__, f.__kwdefaults__])
+        names = _code_names(f.__code__)
+        stack.extend(module_functions[name] for name in names if name in module_functions)
+        # Private globals (_PROFILE, _RENDER_DATA, ...) are run state, not settings
+        constants |= {name for name in names
+                      if name in module and name not in module_functions
+                      and not name.startswith('_') and not inspect.ismodule(module[name])}
+    sources = ''.join(seen[name] for name in sorted(seen))
+    sources += ''.join(f'{name} = {_global_repr(module[name])}\n' for name in sorted(constants))
+    return hashlib.sha256(sources.encode()).hexdigest()
+
+
+def _global_repr(value):
+    # Text of a module global that is stable between runs, reprs with object
+    # addresses are replaced by the content (colormaps) or the name (callables)
+    if isinstance(value, colors.Colormap):
+        lut = value(np.linspace(0, 1, value.N))
+        return f'{type(value).__name__}({value.name}, {hashlib.sha256(lut.tobytes()).hexdigest()})'
+    if isinstance(value, np.ndarray):
+        return f'ndarray({hashlib.sha256(value.tobytes()).hexdigest()})'
+    if isinstance(value, dict):
+        return '{' + ', '.join(f'{_global_repr(k)}: {_global_repr(v)}' for k, v in value.items()) + '}'
+    if isinstance(value, (list, tuple)):
+        return '(' + ', '.join(_global_repr(v) for v in value) + ')'
+    if callable(value):
+        return getattr(value, '__qualname__', type(value).__name__)
+    return repr(value)
+
+
+def _code_names(code):
+    # Global names used by a code object, including nested lambdas/comprehensions
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+
+def figure_key(fn, inputs, data):
+    parts = [fn.__name__, source_digest(fn)] + [data.digest(name) for name in inputs]
+    return hashlib.sha256(' '.join(parts).encode()).hexdigest()
+
+
+def cached_figure_files(cache_dir, fn, key):
+    """Files a figure job produced last time if its key is unchanged, else None"""
+    manifest_filepath = os.path.join(cache_dir, fn.__name__, 'manifest.json')
+    if not os.path.exists(manifest_filepath):
+        return None
+    with open(manifest_filepath) as f:
+        manifest = json.load(f)
+    if manifest['key'] != key:
+        return None
+    if not all(os.path.exists(os.path.join(cache_dir, fn.__name__, name)) for name in manifest['files']):
+        return None
+    return manifest['files']
+
+
+def store_figure_files(cache_dir, fn, key, files):
+    node_dir = os.path.join(cache_dir, fn.__name__)
+    shutil.rmtree(node_dir, ignore_errors=True)
+    os.makedirs(node_dir)
+    for filename in files:
+        shutil.copy2(filename, os.path.join(node_dir, os.path.basename(filename)))
+    with open(os.path.join(node_dir, 'manifest.json'), 'w') as f:
+        json.dump({'key': key, 'files': [os.path.basename(filename) for filename in files]}, f)
+
+
+class RenderArtifacts:
+    """Stand-in for the precipy af while a figure job renders
+
+    Records the files a figure function registers, leaving them in the working
+    directory, so that they can be cached and then added to the real af."""
+
+    def __init__(self):
+        self.files = []
+
+    def add_existing_file(self, filename, remove=False):
+        self.files.append(filename)
+
+    def generate_file(self, filename):
+        with open(filename, 'w') as f:
+            yield f
+        self.files.append(filename)
+
+    def path_to_cached_file(self, filename, fn_name=None):
+        return filename
+
+
+def render_figures(af, data, jobs=None, workers=None, cache_dir=FIGURE_CACHE_DIR, release=True):
+    """Render the figure jobs whose inputs or code changed since the last run
+
+    Each job is keyed on its function's code (see source_digest) and the digests
+    of its inputs. Jobs whose key matches the outputs kept in `cache_dir` are
+    not rendered, their previous files are added to af instead; cache_dir=None
+    renders everything. The remaining jobs are fanned out to a process pool
+    of forked workers using the Agg backend, one figure job at a time, after
+    the data they share has been derived in this process. With workers=1, or
+    where fork is unavailable, they run serially, loading tables as the jobs
+    ask for them. With release, data no remaining job reads is dropped."""
+    global _RENDER_JOBS, _RENDER_DATA
+
+    jobs = jobs or FIGURE_JOBS
+    keys = [figure_key(fn, inputs, data) if cache_dir else None for fn, inputs in jobs]
+    outputs = [cached_figure_files(cache_dir, fn, key) if cache_dir else None
+               for (fn, _), key in zip(jobs, keys)]
+    stale = [i for i, files in enumerate(outputs) if files is None]
+    print(f'Rendering {len(stale)} of {len(jobs)} figure jobs')
+
+    workers = min(workers or os.cpu_count() or 1, max(len(stale), 1))
+    serial = workers == 1 or 'fork' not in mp.get_all_start_methods()
+    if not serial:
+        # Derive the data shared by the stale jobs once, before any fork, the
+        # rest is loaded in the worker rendering the job that reads it
+        data.derive_shared([jobs[i] for i in stale])
+        if release:
+            data.release_unneeded([jobs[i] for i in stale])
+
+    _RENDER_JOBS, _RENDER_DATA = jobs, data
+    try:
+        if serial:
+            rendered = []
+            for n, i in enumerate(stale):
+                rendered.append(_render_job(i))
+                if release:
+                    data.release_unneeded([jobs[j] for j in stale[n + 1:]])
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('fork'),
+                                     initializer=_init_render_worker) as pool:
+                rendered = list(pool.map(_render_job, stale))
+    finally:
+        _RENDER_JOBS, _RENDER_DATA = [], {}
+
+    for i, (files, stages, loads) in zip(stale, rendered):
+        data.loads.extend(loads)
+        if _PROFILE:
+            _PROFILE.stages.extend(stages)
+        if cache_dir:
+            store_figure_files(cache_dir, jobs[i][0], keys[i], files)
+        outputs[i] = files
+
+    for i, files in enumerate(outputs):
+        for filename in files:
+            if i not in stale:
+                shutil.copy2(os.path.join(cache_dir, jobs[i][0].__name__, filename), filename)
+            af.add_existing_file(filename, remove=True)
+
+
+def _init_render_worker():
+    global _RENDER_FORKED
+
+    plt.switch_backend('Agg')
+    _RENDER_FORKED = set(_RENDER_DATA.values), len(_RENDER_DATA.loads)
+
+
+def _render_job(index):
+    # Returns the job's files, the stages it recorded when profiling and the
+    # tables it loaded, so that pool workers hand them back to the parent. A
+    # worker drops the data it loaded for the job once the job is done
+    fn, inputs = _RENDER_JOBS[index]
+    artifacts = RenderArtifacts()
+    run_profile = _PROFILE and RunProfile(_PROFILE.cprofile_dir)
+    with run_profile or nullcontext():
+        with profile_stage(fn.__name__):
+            fn(artifacts, *[_RENDER_DATA[name] for name in inputs])
+        plt.close('all')
+        loads = []
+        if _RENDER_FORKED is not None:
+            names, num_loads = _RENDER_FORKED
+            loads = _RENDER_DATA.loads[num_loads:]
+            del _RENDER_DATA.loads[num_loads:]
+            for name in set(_RENDER_DATA.values) - names:
+                del _RENDER_DATA.values[name]
+        return artifacts.files, run_profile.stages if run_profile else [], loads
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+import report_analytics as ra
+
+
+def random_downloads(rng):
+    # Random integer download matrix with sparse rows and some all-zero rows,
+    # whose coefficient is NaN
+    num_rows, n = rng.integers(1, 40), rng.integers(1, 80)
+    matrix = rng.integers(0, 10_000, (num_rows, n)) * (rng.random((num_rows, n)) < rng.random())
+    matrix[rng.random(num_rows) < 0.2] = 0
+    return matrix
+
+
+def expected_coefficients(matrix):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.array([ra.ineq(row) for row in matrix])
+
+
+@pytest.mark.parametrize('seed', range(50))
+@pytest.mark.parametrize('dtype', [int, float])
+@pytest.mark.parametrize('to_matrix', [np.asarray, sparse.csr_matrix], ids=['dense', 'csr'])
+def test_gini_coefficients_match_ineq(seed, dtype, to_matrix):
+    matrix = random_downloads(np.random.default_rng(seed)).astype(dtype)
+    result = ra.gini_coefficients(to_matrix(matrix))
+    np.testing.assert_array_equal(result, expected_coefficients(matrix))
+
+
+@pytest.mark.parametrize('to_matrix', [np.asarray, sparse.csr_matrix], ids=['dense', 'csr'])
+def test_gini_coefficients_empty_rows(to_matrix):
+    matrix = np.array([[0, 0, 0, 0], [0, 5, 0, 5], [0, 0, 0, 0], [1, 2, 3, 4]])
+    result = ra.gini_coefficients(to_matrix(matrix))
+    assert np.isnan(result[[0, 2]]).all()
+    np.testing.assert_array_equal(result, expected_coefficients(matrix))